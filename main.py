@@ -1,16 +1,39 @@
 import os
 import asyncio
+import csv
+import functools
+import heapq
+import hmac
+import html
+import io
+import json
 import logging
-from datetime import datetime, timedelta, timezone
+import multiprocessing
+import re
+import signal
+import sqlite3
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import NamedTuple
 
 import aiosqlite
 from aiohttp import web
 from dotenv import load_dotenv
 
-from aiogram import Bot, Dispatcher, Router, F
-from aiogram.types import Message, CallbackQuery
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, F
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ParseMode
+from aiogram.types import (
+    Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, Update, FSInputFile
+)
 from aiogram.filters import Command
-from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest, TelegramForbiddenError
 
 # ----------------- НАСТРОЙКИ -----------------
 load_dotenv()
@@ -18,13 +41,88 @@ logging.basicConfig(level=logging.INFO)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0") or 0)
-
-DB_PATH = "shop.db"
+# Bearer-токен для /admin/* на веб-сервере; без него маршруты не регистрируются
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN", "")
+ADMIN_PAGE_SIZE = 20
+ADMIN_PAGE_MAX = 200
+
+# Webhook вместо polling включается, если задан WEBHOOK_URL (публичный адрес сервиса)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+WEBHOOK_MAX_INFLIGHT = int(os.getenv("WEBHOOK_MAX_INFLIGHT", "100") or 100)
+WEBHOOK_BACKPRESSURE_SECONDS = float(os.getenv("WEBHOOK_BACKPRESSURE_SECONDS", "1") or 1)
+# свой Bot API сервер (telegram-bot-api --local) вместо api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+
+# WORKERS>0: этот процесс только принимает апдейты (webhook/polling) и раздаёт их
+# WORKERS процессам-воркерам по user id; база общая (SQLite WAL)
+WORKERS = int(os.getenv("WORKERS", "0") or 0)
+WORKER_MAX_INFLIGHT = int(os.getenv("WORKER_MAX_INFLIGHT", "256") or 256)
+WORKER_START_TIMEOUT = 30
+CACHE_SYNC_SECONDS = float(os.getenv("CACHE_SYNC_SECONDS", "1") or 1)
+
+# sqlite (файл DB_PATH) или postgres (DATABASE_URL, пул PG_POOL_MIN..PG_POOL_MAX)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").strip().lower()
+DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "2") or 2)
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10") or 10)
+DB_PATH = os.getenv("DB_PATH", "shop.db")
+DB_READERS = int(os.getenv("DB_READERS", "4") or 4)
+DB_STATEMENT_CACHE = 256
+DB_FLUSH_MS = float(os.getenv("DB_FLUSH_MS", "2") or 2)
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "256") or 256)
+DB_STREAM_CHUNK = 1000
+# FULL: каждый commit пачки писателя — один fsync WAL (group commit для журнала апдейтов)
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "FULL").strip().upper()
+KNOWN_USERS_CACHE = int(os.getenv("KNOWN_USERS_CACHE", "100000") or 100000)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "100000") or 100000)
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300") or 300)
+# заказы для экрана статуса; TTL — на случай статуса, выставленного в обход бота
+ORDER_CACHE_SIZE = int(os.getenv("ORDER_CACHE_SIZE", "50000") or 50000)
+ORDER_CACHE_TTL = float(os.getenv("ORDER_CACHE_TTL", "300") or 300)
+MY_ORDERS_PAGE_SIZE = 8
+
+# Защита от спама кнопками: per-user token bucket и окно склейки одинаковых нажатий
+THROTTLE_RATE_PER_SEC = float(os.getenv("THROTTLE_RATE_PER_SEC", "2") or 2)
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "5") or 5)
+CALLBACK_DEDUP_SECONDS = float(os.getenv("CALLBACK_DEDUP_SECONDS", "1") or 1)
+CALLBACK_GUARD_USERS = int(os.getenv("CALLBACK_GUARD_USERS", "100000") or 100000)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1").strip() != "0"
+
+# Журнал апдейтов: update_id и тело апдейта пишутся до обработки, отметки о
+# завершении — пачкой раз в JOURNAL_FLUSH_SECONDS; завершённые записи живут
+# JOURNAL_RETENTION_SECONDS (Telegram хранит недоставленные апдейты сутки)
+JOURNAL_ENABLED = os.getenv("JOURNAL_ENABLED", "1").strip() != "0"
+JOURNAL_FLUSH_SECONDS = float(os.getenv("JOURNAL_FLUSH_SECONDS", "0.5") or 0.5)
+JOURNAL_RETENTION_SECONDS = int(os.getenv("JOURNAL_RETENTION_SECONDS", "86400") or 86400)
+JOURNAL_COMPACT_SECONDS = float(os.getenv("JOURNAL_COMPACT_SECONDS", "600") or 600)
+JOURNAL_BATCH_SIZE = 500
+
+CATALOG_CACHE_PAGES = int(os.getenv("CATALOG_CACHE_PAGES", "2048") or 2048)
+CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", "10") or 10)
+# файл каталога (CSV или JSON Lines), который импортируется при старте
+CATALOG_IMPORT_PATH = os.getenv("CATALOG_IMPORT_PATH", "").strip()
+IMPORT_CHUNK_SIZE = 5000
+CATALOG_CACHE_PRODUCTS = int(os.getenv("CATALOG_CACHE_PRODUCTS", "10000") or 10000)
 
 RESERVE_MINUTES = 60
 EXTEND_MINUTES = 30
 MAX_EXTENDS = 1
 
+EXPIRY_BATCH_SIZE = 500
+EXPIRY_RETRY_SECONDS = 5
+
+TELEGRAM_TEXT_LIMIT = 4096
+NOTIFY_RATE_PER_SEC = float(os.getenv("NOTIFY_RATE_PER_SEC", "1") or 1)
+NOTIFY_BURST = int(os.getenv("NOTIFY_BURST", "3") or 3)
+NOTIFY_DIGEST_SECONDS = float(os.getenv("NOTIFY_DIGEST_SECONDS", "2") or 2)
+NOTIFY_BATCH_SIZE = 200
+NOTIFY_MAX_BACKOFF_SECONDS = 60
+# как часто ingest заглядывает в outbox, куда пишут воркеры из других процессов
+NOTIFY_POLL_SECONDS = float(os.getenv("NOTIFY_POLL_SECONDS", "2") or 2)
+
 SUPPORT_USERNAME = "@your_support"  # <-- поменяй
 PAYMENT_CARD_TEXT = (
     "💳 Оплата картой\n"
@@ -37,20 +135,424 @@ PAYMENT_OTHER_TEXT = (
     f"Напишите в поддержку: {SUPPORT_USERNAME}"
 )
 
-def now_utc() -> datetime:
-    return datetime.now(timezone.utc)
+def now_ts() -> int:
+    return int(time.time())
+
+def format_ts(ts: int) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%d.%m.%Y %H:%M UTC")
+
+# ----------------- МЕТРИКИ -----------------
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+class Metrics:
+    """Счётчики и гистограммы в памяти процесса, отдаются на /metrics в формате Prometheus.
+
+    Метки — кортеж пар (имя, значение); запись — один dict lookup и пара сложений.
+    При METRICS_ENABLED=0 middleware и обёртки не подключаются вовсе.
+    """
+
+    def __init__(self, enabled: bool = METRICS_ENABLED):
+        self.enabled = enabled
+        self.help: dict[str, tuple[str, str]] = {}
+        self.counters: dict[str, dict[tuple, float]] = {}
+        self.histograms: dict[str, dict[tuple, Histogram]] = {}
+
+    def counter(self, name: str, help_text: str):
+        self.help[name] = ("counter", help_text)
+        self.counters[name] = {}
+
+    def histogram(self, name: str, help_text: str):
+        self.help[name] = ("histogram", help_text)
+        self.histograms[name] = {}
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        series = self.counters[name]
+        series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name: str, labels: tuple, seconds: float):
+        series = self.histograms[name]
+        hist = series.get(labels)
+        if hist is None:
+            hist = series[labels] = Histogram()
+        hist.observe(seconds)
+
+    @staticmethod
+    def _labels(labels: tuple, extra: tuple = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v).replace(chr(34), "")}"' for k, v in pairs) + "}"
+
+    def render(self, gauges: dict[str, tuple[str, float]] = None) -> str:
+        out = []
+        for name, series in self.counters.items():
+            out.append(f"# HELP {name} {self.help[name][1]}")
+            out.append(f"# TYPE {name} counter")
+            for labels, value in series.items():
+                out.append(f"{name}{self._labels(labels)} {value}")
+        for name, series in self.histograms.items():
+            out.append(f"# HELP {name} {self.help[name][1]}")
+            out.append(f"# TYPE {name} histogram")
+            for labels, hist in series.items():
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), hist.counts):
+                    cumulative += count
+                    out.append(f"{name}_bucket{self._labels(labels, (('le', bound),))} {cumulative}")
+                out.append(f"{name}_sum{self._labels(labels)} {hist.total}")
+                out.append(f"{name}_count{self._labels(labels)} {hist.count}")
+        for name, (help_text, value) in (gauges or {}).items():
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} gauge")
+            out.append(f"{name} {value}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+metrics.histogram("bot_handler_seconds", "Время обработки апдейта хендлером")
+metrics.counter("bot_handler_errors_total", "Исключения в хендлерах")
+metrics.histogram("bot_db_call_seconds", "Время вызова DB-хелпера")
+metrics.counter("bot_db_queries_total", "Запросы к базе по типу")
+metrics.counter("bot_telegram_requests_total", "Вызовы Bot API по методу")
+metrics.counter("bot_telegram_errors_total", "Ошибки Bot API по методу")
+metrics.counter("bot_callbacks_dropped_total", "Нажатия, отброшенные троттлингом и дедупликацией")
+metrics.counter("bot_updates_duplicate_total", "Повторно доставленные апдейты, отброшенные журналом")
+metrics.counter("bot_updates_replayed_total", "Апдейты, повторённые из журнала после рестарта")
+
+def db_timed(fn):
+    """Обёртка DB-хелпера: число вызовов и длительность в bot_db_call_seconds."""
+    if not metrics.enabled:
+        return fn
+    labels = (("helper", fn.__name__),)
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            metrics.observe("bot_db_call_seconds", labels, time.perf_counter() - t0)
+    return wrapper
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Гистограмма времени по имени хендлера (catalog, order, pay, status, ...)."""
+
+    async def __call__(self, handler, event, data):
+        wanted = data.get("handler")
+        labels = (("handler", wanted.callback.__name__ if wanted is not None else "unknown"),)
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", labels)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", labels, time.perf_counter() - t0)
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Считает вызовы и ошибки Bot API на уровне сессии бота."""
+
+    async def __call__(self, make_request, bot, method):
+        labels = (("method", type(method).__name__),)
+        metrics.inc("bot_telegram_requests_total", labels)
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            metrics.inc("bot_telegram_errors_total", labels)
+            raise
 
 # ----------------- БАЗА ДАННЫХ -----------------
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
+_MISSING = object()
+
+class LRUCache:
+    """Словарь ограниченного размера с вытеснением LRU и счётчиками попаданий."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = max(1, maxsize)
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=_MISSING):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+class TTLCache(LRUCache):
+    """LRUCache, в котором запись дополнительно устаревает через ttl секунд."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key, default=_MISSING):
+        item = super().get(key, None)
+        if item is None:
+            return default
+        value, expires = item
+        if expires < time.monotonic():
+            self._data.pop(key, None)
+            self.hits -= 1
+            self.misses += 1
+            return default
+        return value
+
+    def set(self, key, value):
+        super().set(key, (value, time.monotonic() + self.ttl))
+
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    f"PRAGMA synchronous={DB_SYNCHRONOUS}",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+)
+
+_READ_LABELS = (("kind", "read"),)
+_WRITE_LABELS = (("kind", "write"),)
+
+class WriteResult(NamedTuple):
+    lastrowid: int | None
+    rowcount: int
+    rows: list
+
+class Database:
+    """Постоянные соединения с SQLite: N читателей (round-robin) и один писатель.
+
+    Соединения открываются один раз в main(), PRAGMA применяются при открытии,
+    а кэш подготовленных выражений sqlite3 переиспользуется между вызовами.
+
+    Все записи идут через одну задачу-писателя: она копит запросы из разных
+    хендлеров DB_FLUSH_MS миллисекунд (не больше DB_BATCH_SIZE), выполняет их
+    в одной транзакции в отдельном потоке и отдаёт каждому вызывающему его
+    результат через future. Каждый запрос обёрнут в SAVEPOINT, поэтому ошибка
+    одного не откатывает остальные.
+    """
+
+    def __init__(self, path: str, readers: int = DB_READERS,
+                 flush_latency: float = DB_FLUSH_MS / 1000, batch_size: int = DB_BATCH_SIZE):
+        self.path = path
+        self.readers_count = max(1, readers)
+        self.flush_latency = flush_latency
+        self.batch_size = max(1, batch_size)
+        self._readers: list[aiosqlite.Connection] = []
+        self._writer: sqlite3.Connection | None = None
+        self._writer_thread: ThreadPoolExecutor | None = None
+        self._writes: asyncio.Queue | None = None
+        self._writer_task: asyncio.Task | None = None
+        self._next_reader = 0
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path, cached_statements=DB_STATEMENT_CACHE)
+        for pragma in DB_PRAGMAS:
+            await conn.execute(pragma)
+        return conn
+
+    def _connect_writer(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE,
+        )
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        # писатель первым: он переводит файл в WAL до того, как подключатся читатели
+        self._writer_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._writer = await asyncio.get_running_loop().run_in_executor(self._writer_thread, self._connect_writer)
+        self._readers = [await self._connect() for _ in range(self.readers_count)]
+        self._writes = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._write_loop())
+        logging.info("✅ DB pool opened: %s readers + 1 writer (%s)", self.readers_count, self.path)
+
+    async def close(self):
+        if self._writer_task is not None:
+            # дописываем всё, что уже поставлено в очередь
+            self._writes.put_nowait(None)
+            await self._writer_task
+            self._writer_task = None
+        for conn in self._readers:
+            await conn.close()
+        self._readers = []
+        if self._writer is not None:
+            await asyncio.get_running_loop().run_in_executor(self._writer_thread, self._writer.close)
+            self._writer = None
+            self._writer_thread.shutdown()
+            self._writer_thread = None
+
+    def _reader(self) -> aiosqlite.Connection:
+        self._next_reader = (self._next_reader + 1) % len(self._readers)
+        return self._readers[self._next_reader]
+
+    async def fetchone(self, sql: str, params=()):
+        if metrics.enabled:
+            metrics.inc("bot_db_queries_total", _READ_LABELS)
+        async with self._reader().execute(sql, params) as cur:
+            return await cur.fetchone()
+
+    async def fetchall(self, sql: str, params=()):
+        if metrics.enabled:
+            metrics.inc("bot_db_queries_total", _READ_LABELS)
+        return list(await self._reader().execute_fetchall(sql, params))
+
+    async def stream(self, sql: str, params=(), chunk_size: int = DB_STREAM_CHUNK):
+        """Отдаёт результат запроса пачками по chunk_size строк, не держа его в памяти целиком.
+
+        Курсор открыт, пока потребитель (например, HTTP-клиент CSV) читает, поэтому
+        у потока своё соединение: читатель пула с открытым курсором видел бы старый
+        снимок базы во всех остальных запросах и не давал бы сделать checkpoint WAL."""
+        if metrics.enabled:
+            metrics.inc("bot_db_queries_total", _READ_LABELS)
+        conn = await self._connect()
+        try:
+            async with conn.execute(sql, params) as cur:
+                while True:
+                    rows = await cur.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+        finally:
+            await conn.close()
+
+    async def _submit(self, op):
+        if metrics.enabled:
+            metrics.inc("bot_db_queries_total", _WRITE_LABELS)
+        fut = asyncio.get_running_loop().create_future()
+        self._writes.put_nowait((op, fut))
+        return await fut
+
+    async def execute(self, sql: str, params=()) -> WriteResult:
+        """Одна запись; результат возвращается после commit пачки, в которую она попала."""
+        def op(conn: sqlite3.Connection) -> WriteResult:
+            cur = conn.execute(sql, params)
+            rows = cur.fetchall() if cur.description else []
+            return WriteResult(cur.lastrowid, cur.rowcount, rows)
+        return await self._submit(op)
+
+    async def executemany(self, sql: str, seq_of_params) -> WriteResult:
+        def op(conn: sqlite3.Connection) -> WriteResult:
+            cur = conn.executemany(sql, seq_of_params)
+            return WriteResult(cur.lastrowid, cur.rowcount, [])
+        return await self._submit(op)
+
+    async def run(self, fn):
+        """Выполняет fn(conn) в потоке писателя внутри общей транзакции (чтение + запись атомарно)."""
+        return await self._submit(fn)
+
+    async def call(self, fn):
+        """Выполняет fn(conn) в потоке писателя вне пачек; fn сама управляет транзакцией."""
+        await self._submit(None)
+        return await asyncio.get_running_loop().run_in_executor(self._writer_thread, fn, self._writer)
+
+    def _apply(self, batch) -> list:
+        conn = self._writer
+        results = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for op, _ in batch:
+                if op is None:
+                    results.append(None)
+                    continue
+                conn.execute("SAVEPOINT write")
+                try:
+                    results.append(op(conn))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    results.append(e)
+                finally:
+                    conn.execute("RELEASE write")
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            return [e] * len(batch)
+        return results
+
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._writes.get()
+            if item is None:
+                break
+            batch = [item]
+            await asyncio.sleep(self.flush_latency)
+            while len(batch) < self.batch_size and not self._writes.empty():
+                item = self._writes.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                results = await loop.run_in_executor(self._writer_thread, self._apply, batch)
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, fut), result in zip(batch, results):
+                if fut.done():
+                    continue
+                if isinstance(result, Exception):
+                    fut.set_exception(result)
+                else:
+                    fut.set_result(result)
+
+db = Database(DB_PATH)
+
+# Версия схемы хранится в PRAGMA user_version; каждая миграция применяется
+# в своей транзакции ровно один раз.
+MIGRATIONS = (
+    (1, (
+        """
         CREATE TABLE IF NOT EXISTS users (
             tg_user_id INTEGER PRIMARY KEY,
             city TEXT,
             banned INTEGER DEFAULT 0
         )
-        """)
-        await db.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS products (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             city TEXT NOT NULL,
@@ -59,8 +561,8 @@ async def init_db():
             price INTEGER NOT NULL,
             description TEXT DEFAULT ''
         )
-        """)
-        await db.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS orders (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             tg_user_id INTEGER NOT NULL,
@@ -72,189 +574,1808 @@ async def init_db():
             reserved_until TEXT NOT NULL,
             extends_count INTEGER DEFAULT 0
         )
-        """)
-        await db.commit()
+        """,
+    )),
+    # время заказа в unix epoch (INTEGER) вместо ISO-строк + индексы горячих запросов
+    (2, (
+        """
+        CREATE TABLE orders_v2 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tg_user_id INTEGER NOT NULL,
+            city TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            total_price INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            reserved_until INTEGER NOT NULL,
+            extends_count INTEGER DEFAULT 0
+        )
+        """,
+        """
+        INSERT INTO orders_v2(id, tg_user_id, city, product_id, total_price, status,
+                              created_at, reserved_until, extends_count)
+        SELECT id, tg_user_id, city, product_id, total_price, status,
+               CAST(strftime('%s', created_at) AS INTEGER),
+               CAST(strftime('%s', reserved_until) AS INTEGER),
+               extends_count
+        FROM orders
+        """,
+        "DROP TABLE orders",
+        "ALTER TABLE orders_v2 RENAME TO orders",
+        "CREATE INDEX idx_orders_user ON orders(tg_user_id, id)",
+        "CREATE INDEX idx_orders_status_reserved ON orders(status, reserved_until)",
+        "CREATE INDEX idx_products_city ON products(city, name, price, variant)",
+    )),
+    # очередь исходящих уведомлений админу, переживает рестарт
+    (3, (
+        """
+        CREATE TABLE outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+        """,
+    )),
+    # уникальность (city, name, variant) для upsert при импорте; дубли сливаются
+    # в товар с минимальным id, заказы перевешиваются на него. Цена и описание
+    # берутся у самой новой строки — как при upsert, где побеждает последнее значение
+    (4, (
+        """
+        UPDATE products SET (price, description) = (
+            SELECT n.price, n.description FROM products n
+            WHERE n.city=products.city AND n.name=products.name AND n.variant=products.variant
+            ORDER BY n.id DESC LIMIT 1
+        )
+        WHERE id IN (SELECT MIN(id) FROM products GROUP BY city, name, variant HAVING COUNT(*) > 1)
+        """,
+        """
+        UPDATE orders SET product_id = (
+            SELECT MIN(k.id) FROM products p
+            JOIN products k ON k.city=p.city AND k.name=p.name AND k.variant=p.variant
+            WHERE p.id=orders.product_id
+        )
+        WHERE product_id IN (SELECT id FROM products)
+        """,
+        "DELETE FROM products WHERE id NOT IN (SELECT MIN(id) FROM products GROUP BY city, name, variant)",
+        "CREATE UNIQUE INDEX idx_products_key ON products(city, name, variant)",
+    )),
+    # сводка заказов по дням для админки: триггеры обновляют её на каждом
+    # INSERT и смене статуса, отчёты не перечитывают всю историю orders
+    (5, (
+        """
+        CREATE TABLE order_stats (
+            day INTEGER NOT NULL,
+            city TEXT NOT NULL,
+            status TEXT NOT NULL,
+            orders INTEGER NOT NULL,
+            revenue INTEGER NOT NULL,
+            PRIMARY KEY (day, city, status)
+        ) WITHOUT ROWID
+        """,
+        """
+        INSERT INTO order_stats(day, city, status, orders, revenue)
+        SELECT created_at / 86400, city, status, COUNT(*), SUM(total_price)
+        FROM orders GROUP BY 1, 2, 3
+        """,
+        """
+        CREATE TRIGGER trg_order_stats_insert AFTER INSERT ON orders BEGIN
+            INSERT INTO order_stats(day, city, status, orders, revenue)
+            VALUES (NEW.created_at / 86400, NEW.city, NEW.status, 1, NEW.total_price)
+            ON CONFLICT(day, city, status) DO UPDATE
+            SET orders = orders + 1, revenue = revenue + excluded.revenue;
+        END
+        """,
+        """
+        CREATE TRIGGER trg_order_stats_status AFTER UPDATE OF status ON orders
+        WHEN OLD.status != NEW.status BEGIN
+            UPDATE order_stats SET orders = orders - 1, revenue = revenue - OLD.total_price
+            WHERE day = OLD.created_at / 86400 AND city = OLD.city AND status = OLD.status;
+            INSERT INTO order_stats(day, city, status, orders, revenue)
+            VALUES (NEW.created_at / 86400, NEW.city, NEW.status, 1, NEW.total_price)
+            ON CONFLICT(day, city, status) DO UPDATE
+            SET orders = orders + 1, revenue = revenue + excluded.revenue;
+        END
+        """,
+        """
+        CREATE TRIGGER trg_order_stats_delete AFTER DELETE ON orders BEGIN
+            UPDATE order_stats SET orders = orders - 1, revenue = revenue - OLD.total_price
+            WHERE day = OLD.created_at / 86400 AND city = OLD.city AND status = OLD.status;
+        END
+        """,
+        "CREATE INDEX idx_orders_created ON orders(created_at)",
+        "CREATE INDEX idx_orders_status_created ON orders(status, created_at)",
+        "CREATE INDEX idx_orders_city_created ON orders(city, created_at)",
+    )),
+    # общие версии кэшей: воркеры в режиме WORKERS>0 сверяются с ними,
+    # чтобы правка каталога в одном процессе сбрасывала кэш во всех
+    (6, (
+        """
+        CREATE TABLE cache_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """,
+        "INSERT INTO cache_versions(name, version) VALUES ('catalog', 0)",
+    )),
+    (7, (
+        # заказ помнит апдейт, который его создал: повторная доставка не создаст второй
+        "ALTER TABLE orders ADD COLUMN update_id INTEGER",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_update ON orders(update_id)",
+        """
+        CREATE TABLE IF NOT EXISTS update_journal (
+            update_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            received_at INTEGER NOT NULL,
+            done_at INTEGER
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_update_journal_done ON update_journal(done_at, update_id)",
+    )),
+)
 
-async def seed_demo_products():
-    # Поменяй на свои ЛЕГАЛЬНЫЕ товары (или добавляй через /addproduct)
-    demo = [
-        ("КРИВОЙ РОГ", "Кофе в зернах", "250 г", 280, "Свежая обжарка"),
-        ("КРИВОЙ РОГ", "Кофе в зернах", "500 г", 560, "Свежая обжарка"),
-        ("КРИВОЙ РОГ", "Чай листовой", "100 г", 220, "Насыщенный вкус"),
-    ]
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT COUNT(*) FROM products")
-        (cnt,) = await cur.fetchone()
-        if cnt == 0:
-            await db.executemany(
-                "INSERT INTO products(city,name,variant,price,description) VALUES(?,?,?,?,?)",
-                demo
-            )
-            await db.commit()
+SCHEMA_VERSION = MIGRATIONS[-1][0]
 
-async def ensure_user(uid: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT 1 FROM users WHERE tg_user_id=?", (uid,))
-        if await cur.fetchone() is None:
-            await db.execute("INSERT INTO users(tg_user_id, city, banned) VALUES(?,?,0)", (uid, None))
-            await db.commit()
-
-async def get_user(uid: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT city, banned FROM users WHERE tg_user_id=?", (uid,))
-        row = await cur.fetchone()
-        return row if row else (None, 0)
+def _migrate(conn: sqlite3.Connection) -> list[int]:
+    (version,) = conn.execute("PRAGMA user_version").fetchone()
+    applied = []
+    for target, statements in MIGRATIONS:
+        if target <= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute(f"PRAGMA user_version={target}")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        applied.append(target)
+    return applied
+
+# ----------------- ХРАНИЛИЩЕ -----------------
+ORDER_COLUMNS = (
+    "id", "tg_user_id", "city", "product_id", "total_price", "status",
+    "created_at", "reserved_until", "extends_count",
+)
 
-async def set_city(uid: int, city: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET city=? WHERE tg_user_id=?", (city, uid))
-        await db.commit()
+PRODUCT_UPSERT_SQL = """
+    INSERT INTO products(city, name, variant, price, description) VALUES(?,?,?,?,?)
+    ON CONFLICT(city, name, variant) DO UPDATE SET
+        price=excluded.price, description=excluded.description
+"""
+
+# Страница каталога по ключу (город, направление, имя-якорь): keyset по name,
+# поэтому читаются только строки показываемой страницы, без OFFSET
+_PAGE_SQL = """
+    SELECT name, MIN(id), COUNT(*), MIN(price), MIN(variant)
+    FROM products
+    WHERE city=? AND name {op} ?
+    GROUP BY name
+    ORDER BY name {order}
+    LIMIT ?
+"""
+
+class OrderFilter(NamedTuple):
+    status: str | None = None
+    city: str | None = None
+    since: int | None = None
+    until: int | None = None
+
+def _order_where(f: OrderFilter) -> tuple[str, list]:
+    clauses, params = [], []
+    for clause, value in (("status=?", f.status), ("city=?", f.city),
+                          ("created_at>=?", f.since), ("created_at<?", f.until)):
+        if value is not None:
+            clauses.append(clause)
+            params.append(value)
+    return " AND ".join(clauses) or "TRUE", params
+
+def order_page_sql(f: OrderFilter, cursor: bool) -> str:
+    where, _ = _order_where(f)
+    if cursor:
+        where += " AND (created_at, id) < (?, ?)"
+    return (f"SELECT {', '.join(ORDER_COLUMNS)} FROM orders WHERE {where} "
+            "ORDER BY created_at DESC, id DESC LIMIT ?")
+
+# Read-model заказа: заказ вместе с названием и вариантом товара одним JOIN
+# (LEFT — товар могли удалить из каталога, заказ при этом остаётся)
+ORDER_VIEW_SQL = """
+    SELECT o.id, o.tg_user_id, o.city, o.product_id, p.name, p.variant,
+           o.total_price, o.status, o.created_at, o.reserved_until, o.extends_count
+    FROM orders o LEFT JOIN products p ON p.id=o.product_id
+"""
+
+def user_orders_sql(before: bool) -> str:
+    """История заказов пользователя, новые первыми; keyset по индексу (tg_user_id, id)."""
+    where = "o.tg_user_id=? AND o.id<?" if before else "o.tg_user_id=?"
+    return f"{ORDER_VIEW_SQL} WHERE {where} ORDER BY o.id DESC LIMIT ?"
+
+class Storage(ABC):
+    """Репозиторий пользователей, товаров и заказов.
+
+    Запросы написаны один раз с плейсхолдерами `?` на общем подмножестве SQL
+    (upsert, RETURNING, row values), бэкенд реализует только примитивы
+    fetchone/fetchall/execute/executemany/stream, открытие и миграции.
+    Бэкенд выбирается STORAGE_BACKEND; проверка совместимости — bench.py conformance.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    async def open(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def close(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def migrate(self) -> list[int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def fetchone(self, sql: str, params=()):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def fetchall(self, sql: str, params=()) -> list:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def execute(self, sql: str, params=()) -> WriteResult:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def executemany(self, sql: str, seq_of_params) -> WriteResult:
+        raise NotImplementedError
+
+    @abstractmethod
+    def stream(self, sql: str, params=(), chunk_size: int = DB_STREAM_CHUNK):
+        raise NotImplementedError
+
+    # --- пользователи ---
+    async def ensure_user(self, uid: int):
+        await self.execute(
+            "INSERT INTO users(tg_user_id, city, banned) VALUES(?,?,0) ON CONFLICT(tg_user_id) DO NOTHING",
+            (uid, None),
+        )
 
-async def get_cities():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT DISTINCT city FROM products ORDER BY city")
-        rows = await cur.fetchall()
+    async def get_user(self, uid: int):
+        return await self.fetchone("SELECT city, banned FROM users WHERE tg_user_id=?", (uid,))
+
+    async def set_city(self, uid: int, city: str):
+        # upsert: создаёт пользователя, если его ещё нет, одной записью вместо двух
+        res = await self.execute("""
+            INSERT INTO users(tg_user_id, city, banned) VALUES(?,?,0)
+            ON CONFLICT(tg_user_id) DO UPDATE SET city=excluded.city
+            RETURNING city, banned
+        """, (uid, city))
+        return res.rows[0]
+
+    # --- товары ---
+    async def count_products(self) -> int:
+        (cnt,) = await self.fetchone("SELECT COUNT(*) FROM products")
+        return cnt
+
+    async def has_products(self) -> bool:
+        return await self.fetchone("SELECT 1 FROM products LIMIT 1") is not None
+
+    async def upsert_products(self, rows):
+        """rows: (city, name, variant, price, description); существующие товары обновляются."""
+        await self.executemany(PRODUCT_UPSERT_SQL, rows)
+
+    async def cities(self) -> list[str]:
+        rows = await self.fetchall("SELECT DISTINCT city FROM products ORDER BY city")
         return [r[0] for r in rows]
 
-async def get_products_by_city(city: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT id, name, variant, price
+    async def catalog_page(self, city: str, op: str, anchor: str, limit: int):
+        order = "DESC" if op == "<" else "ASC"
+        return await self.fetchall(_PAGE_SQL.format(op=op, order=order), (city, anchor, limit))
+
+    async def has_names_before(self, city: str, anchor: str) -> bool:
+        row = await self.fetchone("SELECT 1 FROM products WHERE city=? AND name<? LIMIT 1", (city, anchor))
+        return row is not None
+
+    async def product_group(self, city: str, name: str):
+        return await self.fetchall("""
+            SELECT id, variant, price
             FROM products
-            WHERE city=?
-            ORDER BY name, price
-        """, (city,))
-        return await cur.fetchall()
+            WHERE city=? AND name=?
+            ORDER BY price, variant
+        """, (city, name))
 
-async def get_product(pid: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
+    async def product(self, pid: int):
+        return await self.fetchone("""
             SELECT id, city, name, variant, price, description
             FROM products
             WHERE id=?
         """, (pid,))
-        return await cur.fetchone()
-
-async def create_order(uid: int, city: str, product_id: int, total: int) -> int:
-    created = now_utc()
-    reserved_until = created + timedelta(minutes=RESERVE_MINUTES)
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            INSERT INTO orders(tg_user_id, city, product_id, total_price, status, created_at, reserved_until, extends_count)
-            VALUES(?,?,?,?,?,?,?,0)
-        """, (uid, city, product_id, total, "AWAITING_PAYMENT", created.isoformat(), reserved_until.isoformat()))
-        await db.commit()
-        return int(cur.lastrowid)
 
-async def get_order(order_id: int, uid: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
+    async def products_head(self, limit: int):
+        return await self.fetchall("""
+            SELECT id, city, name, variant, price, description
+            FROM products
+            ORDER BY id
+            LIMIT ?
+        """, (limit,))
+
+    def stream_products(self):
+        return self.stream(
+            "SELECT city, name, variant, price, description FROM products ORDER BY city, name, variant"
+        )
+
+    # --- заказы ---
+    @abstractmethod
+    async def create_order(self, uid: int, city: str, product_id: int, total: int, created: int,
+                           reserved_until: int, update_id: int | None = None, notice=None) -> tuple[int, bool]:
+        """(id заказа, создан ли сейчас). С update_id, уже создавшим заказ, возвращает тот же
+        заказ. notice=(chat_id, text(order_id)) пишется в outbox в той же транзакции."""
+        raise NotImplementedError
+
+    async def get_order(self, order_id: int, uid: int):
+        return await self.fetchone("""
             SELECT id, city, product_id, total_price, status, created_at, reserved_until, extends_count
             FROM orders
             WHERE id=? AND tg_user_id=?
         """, (order_id, uid))
-        return await cur.fetchone()
 
-async def get_last_order_id(uid: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
+    async def order_view(self, order_id: int, uid: int):
+        return await self.fetchone(ORDER_VIEW_SQL + " WHERE o.id=? AND o.tg_user_id=?", (order_id, uid))
+
+    async def user_orders(self, uid: int, before: int | None, limit: int):
+        if before is None:
+            return await self.fetchall(user_orders_sql(False), (uid, limit))
+        return await self.fetchall(user_orders_sql(True), (uid, before, limit))
+
+    async def last_order_id(self, uid: int) -> int | None:
+        row = await self.fetchone("""
             SELECT id FROM orders
             WHERE tg_user_id=?
             ORDER BY id DESC
             LIMIT 1
         """, (uid,))
-        row = await cur.fetchone()
         return row[0] if row else None
 
-async def set_order_status(order_id: int, uid: int, status: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE orders SET status=? WHERE id=? AND tg_user_id=?", (status, order_id, uid))
-        await db.commit()
+    @abstractmethod
+    async def transition_order(self, order_id: int, uid: int, to: str, sources: tuple, now: int,
+                               notice: tuple[int, str] | None = None) -> bool:
+        """notice=(chat_id, text) пишется в outbox в той же транзакции, только если переход удался."""
+        raise NotImplementedError
+
+    async def extend_reserve(self, order_id: int, uid: int, seconds: int, max_extends: int, now: int) -> int | None:
+        """Новый reserved_until или None, если продлевать нельзя."""
+        res = await self.execute("""
+            UPDATE orders SET reserved_until=reserved_until+?, extends_count=extends_count+1
+            WHERE id=? AND tg_user_id=? AND status='AWAITING_PAYMENT'
+              AND extends_count<? AND reserved_until>=?
+            RETURNING reserved_until
+        """, (seconds, order_id, uid, max_extends, now))
+        return res.rows[0][0] if res.rows else None
+
+    async def pending_reservations(self, shard: tuple[int, int] | None = None):
+        sql = "SELECT id, reserved_until FROM orders WHERE status='AWAITING_PAYMENT'"
+        if shard is None:
+            return await self.fetchall(sql)
+        index, count = shard
+        return await self.fetchall(sql + " AND tg_user_id % ? = ?", (count, index))
+
+    async def expire_orders(self, order_ids: list[int], now: int):
+        placeholders = ",".join("?" * len(order_ids))
+        await self.execute(f"""
+            UPDATE orders SET status='EXPIRED'
+            WHERE status='AWAITING_PAYMENT' AND reserved_until<=? AND id IN ({placeholders})
+        """, (now, *order_ids))
+
+    async def list_orders(self, f: OrderFilter, cursor: tuple[int, int] | None, limit: int):
+        _, params = _order_where(f)
+        if cursor:
+            params += list(cursor)
+        return await self.fetchall(order_page_sql(f, bool(cursor)), (*params, limit))
+
+    def stream_orders(self, f: OrderFilter):
+        where, params = _order_where(f)
+        return self.stream(
+            f"SELECT {', '.join(ORDER_COLUMNS)} FROM orders WHERE {where} ORDER BY created_at DESC, id DESC",
+            params,
+        )
+
+    def stream_order_stats(self, first_day: int, last_day: int, city: str | None = None):
+        """Строки order_stats (city, status, orders, revenue) за дни [first_day, last_day]."""
+        sql = "SELECT city, status, orders, revenue FROM order_stats WHERE day BETWEEN ? AND ?"
+        params = [first_day, last_day]
+        if city:
+            sql += " AND city=?"
+            params.append(city)
+        return self.stream(sql, params)
+
+    # --- outbox и версии кэшей ---
+    async def outbox_batch(self, limit: int):
+        return await self.fetchall("SELECT id, chat_id, text FROM outbox ORDER BY id LIMIT ?", (limit,))
+
+    async def outbox_delete(self, ids: list[int]):
+        placeholders = ",".join("?" * len(ids))
+        await self.execute(f"DELETE FROM outbox WHERE id IN ({placeholders})", ids)
+
+    async def cache_version(self, name: str) -> int:
+        row = await self.fetchone("SELECT version FROM cache_versions WHERE name=?", (name,))
+        return row[0] if row else 0
+
+    async def bump_cache_version(self, name: str):
+        await self.execute("UPDATE cache_versions SET version=version+1 WHERE name=?", (name,))
+
+    # --- журнал апдейтов ---
+    async def journal_record(self, update_id: int, user_id: int, payload: str, received_at: int) -> bool:
+        """False, если апдейт с таким update_id уже записан."""
+        res = await self.execute("""
+            INSERT INTO update_journal(update_id, user_id, payload, received_at) VALUES(?,?,?,?)
+            ON CONFLICT(update_id) DO NOTHING
+        """, (update_id, user_id, payload, received_at))
+        return res.rowcount > 0
+
+    async def journal_done(self, update_ids: list[int], done_at: int):
+        # тело больше не нужно: для идемпотентности хватает update_id
+        placeholders = ",".join("?" * len(update_ids))
+        await self.execute(
+            f"UPDATE update_journal SET done_at=?, payload='' WHERE update_id IN ({placeholders})",
+            (done_at, *update_ids),
+        )
+
+    async def journal_pending(self, shard: tuple[int, int] | None = None):
+        sql = "SELECT update_id, payload FROM update_journal WHERE done_at IS NULL"
+        if shard is None:
+            return await self.fetchall(sql + " ORDER BY update_id")
+        index, count = shard
+        return await self.fetchall(sql + " AND user_id % ? = ? ORDER BY update_id", (count, index))
+
+    async def journal_compact(self, done_before: int, limit: int) -> int:
+        res = await self.execute("""
+            DELETE FROM update_journal WHERE update_id IN (
+                SELECT update_id FROM update_journal WHERE done_at < ? LIMIT ?
+            )
+        """, (done_before, limit))
+        return res.rowcount
+
+ORDER_INSERT_SQL = """
+    INSERT INTO orders(tg_user_id, city, product_id, total_price, status, created_at, reserved_until,
+                       extends_count, update_id)
+    VALUES(?,?,?,?,'AWAITING_PAYMENT',?,?,0,?)
+    ON CONFLICT(update_id) DO NOTHING
+    RETURNING id
+"""
+OUTBOX_INSERT_SQL = "INSERT INTO outbox(chat_id, text, created_at) VALUES(?,?,?)"
+
+def transition_sql(sources: int) -> str:
+    # заявить оплату можно только пока бронь не истекла, даже если планировщик ещё не успел
+    return f"""
+        UPDATE orders SET status=?
+        WHERE id=? AND tg_user_id=? AND status IN ({",".join("?" * sources)})
+          AND (? != 'PAID_REPORTED' OR status != 'AWAITING_PAYMENT' OR reserved_until >= ?)
+    """
+
+class SQLiteStorage(Storage):
+    """Storage поверх Database: пул читателей и пакетный писатель, схема — MIGRATIONS."""
+
+    name = "sqlite"
+
+    def __init__(self, database: Database):
+        self.db = database
+
+    async def open(self):
+        await self.db.open()
+
+    async def close(self):
+        await self.db.close()
+
+    async def migrate(self) -> list[int]:
+        # обычный рестарт: схема уже актуальна, писателя и транзакций не трогаем
+        (version,) = await self.fetchone("PRAGMA user_version")
+        if version >= SCHEMA_VERSION:
+            return []
+        return await self.db.call(_migrate)
+
+    async def fetchone(self, sql: str, params=()):
+        return await self.db.fetchone(sql, params)
+
+    async def fetchall(self, sql: str, params=()) -> list:
+        return await self.db.fetchall(sql, params)
+
+    async def execute(self, sql: str, params=()) -> WriteResult:
+        return await self.db.execute(sql, params)
+
+    async def executemany(self, sql: str, seq_of_params) -> WriteResult:
+        return await self.db.executemany(sql, seq_of_params)
+
+    def stream(self, sql: str, params=(), chunk_size: int = DB_STREAM_CHUNK):
+        return self.db.stream(sql, params, chunk_size)
+
+    async def create_order(self, uid: int, city: str, product_id: int, total: int, created: int,
+                           reserved_until: int, update_id: int | None = None, notice=None) -> tuple[int, bool]:
+        def op(conn: sqlite3.Connection) -> tuple[int, bool]:
+            rows = conn.execute(
+                ORDER_INSERT_SQL, (uid, city, product_id, total, created, reserved_until, update_id)
+            ).fetchall()
+            if not rows:
+                (order_id,) = conn.execute("SELECT id FROM orders WHERE update_id=?", (update_id,)).fetchone()
+                return order_id, False
+            order_id = rows[0][0]
+            if notice is not None:
+                chat_id, text = notice
+                conn.execute(OUTBOX_INSERT_SQL, (chat_id, text(order_id), created))
+            return order_id, True
+        return await self.db.run(op)
+
+    async def transition_order(self, order_id: int, uid: int, to: str, sources: tuple, now: int,
+                               notice: tuple[int, str] | None = None) -> bool:
+        params = (to, order_id, uid, *sources, to, now)
+        if notice is None:
+            res = await self.execute(transition_sql(len(sources)), params)
+            return res.rowcount > 0
+
+        def op(conn: sqlite3.Connection) -> bool:
+            if conn.execute(transition_sql(len(sources)), params).rowcount == 0:
+                return False
+            conn.execute(OUTBOX_INSERT_SQL, (notice[0], notice[1], now))
+            return True
+        return await self.db.run(op)
+
+# Схема PostgreSQL сразу в конечном виде SQLite-миграций 1–6. Строковые колонки
+# каталога в COLLATE "C", чтобы порядок страниц совпадал с BINARY в SQLite.
+PG_MIGRATIONS = (
+    (1, (
+        """
+        CREATE TABLE users (
+            tg_user_id BIGINT PRIMARY KEY,
+            city TEXT,
+            banned INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE products (
+            id BIGSERIAL PRIMARY KEY,
+            city TEXT COLLATE "C" NOT NULL,
+            name TEXT COLLATE "C" NOT NULL,
+            variant TEXT COLLATE "C" NOT NULL,
+            price INTEGER NOT NULL,
+            description TEXT DEFAULT ''
+        )
+        """,
+        "CREATE UNIQUE INDEX idx_products_key ON products(city, name, variant)",
+        "CREATE INDEX idx_products_city ON products(city, name, price, variant)",
+        """
+        CREATE TABLE orders (
+            id BIGSERIAL PRIMARY KEY,
+            tg_user_id BIGINT NOT NULL,
+            city TEXT NOT NULL,
+            product_id BIGINT NOT NULL,
+            total_price INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            created_at BIGINT NOT NULL,
+            reserved_until BIGINT NOT NULL,
+            extends_count INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        "CREATE INDEX idx_orders_user ON orders(tg_user_id, id)",
+        "CREATE INDEX idx_orders_status_reserved ON orders(status, reserved_until)",
+        "CREATE INDEX idx_orders_created ON orders(created_at, id)",
+        "CREATE INDEX idx_orders_status_created ON orders(status, created_at, id)",
+        "CREATE INDEX idx_orders_city_created ON orders(city, created_at, id)",
+        """
+        CREATE TABLE outbox (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            created_at BIGINT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE order_stats (
+            day BIGINT NOT NULL,
+            city TEXT NOT NULL,
+            status TEXT NOT NULL,
+            orders BIGINT NOT NULL,
+            revenue BIGINT NOT NULL,
+            PRIMARY KEY (day, city, status)
+        )
+        """,
+        """
+        CREATE FUNCTION order_stats_apply() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE order_stats SET orders = orders - 1, revenue = revenue - OLD.total_price
+                WHERE day = OLD.created_at / 86400 AND city = OLD.city AND status = OLD.status;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO order_stats(day, city, status, orders, revenue)
+                VALUES (NEW.created_at / 86400, NEW.city, NEW.status, 1, NEW.total_price)
+                ON CONFLICT (day, city, status) DO UPDATE
+                SET orders = order_stats.orders + 1, revenue = order_stats.revenue + excluded.revenue;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER trg_order_stats_rows AFTER INSERT OR DELETE ON orders
+        FOR EACH ROW EXECUTE FUNCTION order_stats_apply()
+        """,
+        """
+        CREATE TRIGGER trg_order_stats_status AFTER UPDATE OF status ON orders
+        FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status) EXECUTE FUNCTION order_stats_apply()
+        """,
+        """
+        CREATE TABLE cache_versions (
+            name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL
+        )
+        """,
+        "INSERT INTO cache_versions(name, version) VALUES ('catalog', 0)",
+    )),
+    (2, (
+        "ALTER TABLE orders ADD COLUMN update_id BIGINT",
+        "CREATE UNIQUE INDEX idx_orders_update ON orders(update_id)",
+        """
+        CREATE TABLE update_journal (
+            update_id BIGINT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            payload TEXT NOT NULL,
+            received_at BIGINT NOT NULL,
+            done_at BIGINT
+        )
+        """,
+        "CREATE INDEX idx_update_journal_done ON update_journal(done_at, update_id)",
+    )),
+)
+
+# ключ advisory-lock, под которым мигрирует ровно один процесс
+_PG_MIGRATION_LOCK = 7_301_802
+
+@functools.lru_cache(maxsize=DB_STATEMENT_CACHE)
+def _pg_sql(sql: str) -> str:
+    """`?` -> `$1, $2, ...`; в запросах Storage `?` встречается только как плейсхолдер."""
+    parts = sql.split("?")
+    return parts[0] + "".join(f"${i}{part}" for i, part in enumerate(parts[1:], 1))
+
+class PostgresStorage(Storage):
+    """Storage на asyncpg с пулом соединений (DATABASE_URL, PG_POOL_MIN..PG_POOL_MAX).
+
+    Каждая запись — отдельная автокоммит-транзакция на соединении из пула, так что
+    писатели из разных процессов не упираются в одну блокировку файла, как в SQLite.
+    """
+
+    name = "postgres"
+
+    def __init__(self, dsn: str, min_size: int = PG_POOL_MIN, max_size: int = PG_POOL_MAX):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+
+    async def open(self):
+        if self.pool is not None:
+            return
+        try:
+            import asyncpg
+        except ImportError:
+            raise RuntimeError(
+                "STORAGE_BACKEND=postgres требует asyncpg: pip install -r requirements-postgres.txt"
+            ) from None
+
+        self.pool = await asyncpg.create_pool(
+            self.dsn, min_size=self.min_size, max_size=self.max_size,
+            statement_cache_size=DB_STATEMENT_CACHE,
+        )
+        logging.info("✅ PostgreSQL pool opened: %s..%s connections", self.min_size, self.max_size)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def migrate(self) -> list[int]:
+        if (await self.pool.fetchval("SELECT to_regclass('schema_migrations')") is not None
+                and await self.pool.fetchval("SELECT MAX(version) FROM schema_migrations") == PG_MIGRATIONS[-1][0]):
+            return []
+        applied = []
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _PG_MIGRATION_LOCK)
+            await conn.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY)")
+            version = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+            for target, statements in PG_MIGRATIONS:
+                if target <= version:
+                    continue
+                for sql in statements:
+                    await conn.execute(sql)
+                await conn.execute("INSERT INTO schema_migrations(version) VALUES($1)", target)
+                applied.append(target)
+        return applied
+
+    async def fetchone(self, sql: str, params=()):
+        if metrics.enabled:
+            metrics.inc("bot_db_queries_total", _READ_LABELS)
+        return await self.pool.fetchrow(_pg_sql(sql), *params)
+
+    async def fetchall(self, sql: str, params=()) -> list:
+        if metrics.enabled:
+            metrics.inc("bot_db_queries_total", _READ_LABELS)
+        return await self.pool.fetch(_pg_sql(sql), *params)
+
+    async def execute(self, sql: str, params=()) -> WriteResult:
+        if metrics.enabled:
+            metrics.inc("bot_db_queries_total", _WRITE_LABELS)
+        if "RETURNING" in sql:
+            rows = await self.pool.fetch(_pg_sql(sql), *params)
+            return WriteResult(None, len(rows), rows)
+        status = await self.pool.execute(_pg_sql(sql), *params)
+        # статус вида "UPDATE 3" / "INSERT 0 1": число строк — последнее слово
+        return WriteResult(None, int(status.rsplit(" ", 1)[-1]), [])
+
+    async def executemany(self, sql: str, seq_of_params) -> WriteResult:
+        if metrics.enabled:
+            metrics.inc("bot_db_queries_total", _WRITE_LABELS)
+        rows = list(seq_of_params)
+        await self.pool.executemany(_pg_sql(sql), rows)
+        return WriteResult(None, len(rows), [])
+
+    async def create_order(self, uid: int, city: str, product_id: int, total: int, created: int,
+                           reserved_until: int, update_id: int | None = None, notice=None) -> tuple[int, bool]:
+        if metrics.enabled:
+            metrics.inc("bot_db_queries_total", _WRITE_LABELS)
+        async with self.pool.acquire() as conn, conn.transaction():
+            order_id = await conn.fetchval(
+                _pg_sql(ORDER_INSERT_SQL), uid, city, product_id, total, created, reserved_until, update_id
+            )
+            if order_id is None:
+                return await conn.fetchval("SELECT id FROM orders WHERE update_id=$1", update_id), False
+            if notice is not None:
+                chat_id, text = notice
+                await conn.execute(_pg_sql(OUTBOX_INSERT_SQL), chat_id, text(order_id), created)
+            return order_id, True
+
+    async def transition_order(self, order_id: int, uid: int, to: str, sources: tuple, now: int,
+                               notice: tuple[int, str] | None = None) -> bool:
+        params = (to, order_id, uid, *sources, to, now)
+        if notice is None:
+            res = await self.execute(transition_sql(len(sources)), params)
+            return res.rowcount > 0
+        if metrics.enabled:
+            metrics.inc("bot_db_queries_total", _WRITE_LABELS)
+        async with self.pool.acquire() as conn, conn.transaction():
+            status = await conn.execute(_pg_sql(transition_sql(len(sources))), *params)
+            if int(status.rsplit(" ", 1)[-1]) == 0:
+                return False
+            await conn.execute(_pg_sql(OUTBOX_INSERT_SQL), notice[0], notice[1], now)
+            return True
+
+    async def stream(self, sql: str, params=(), chunk_size: int = DB_STREAM_CHUNK):
+        if metrics.enabled:
+            metrics.inc("bot_db_queries_total", _READ_LABELS)
+        # серверный курсор живёт только внутри транзакции
+        async with self.pool.acquire() as conn, conn.transaction():
+            cur = await conn.cursor(_pg_sql(sql), *params)
+            while rows := await cur.fetch(chunk_size):
+                yield rows
+
+def create_storage() -> Storage:
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage(db)
+    if STORAGE_BACKEND == "postgres":
+        if not DATABASE_URL:
+            raise RuntimeError("DATABASE_URL не задан в Variables.")
+        return PostgresStorage(DATABASE_URL)
+    raise RuntimeError(f"Неизвестный STORAGE_BACKEND: {STORAGE_BACKEND}")
+
+storage = create_storage()
+
+async def init_db():
+    for target in await storage.migrate():
+        logging.info("✅ DB migrated to schema version %s", target)
+
+async def seed_demo_products():
+    # Поменяй на свои ЛЕГАЛЬНЫЕ товары (или добавляй через /addproduct)
+    demo = [
+        ("КРИВОЙ РОГ", "Кофе в зернах", "250 г", 280, "Свежая обжарка"),
+        ("КРИВОЙ РОГ", "Кофе в зернах", "500 г", 560, "Свежая обжарка"),
+        ("КРИВОЙ РОГ", "Чай листовой", "100 г", 220, "Насыщенный вкус"),
+    ]
+    if not await storage.has_products():
+        await storage.upsert_products(demo)
+
+# id пользователей, которые точно уже есть в users: повторный /start не идёт в БД
+_known_users = LRUCache(KNOWN_USERS_CACHE)
+
+@db_timed
+async def ensure_user(uid: int):
+    if _known_users.get(uid, None) is None:
+        await storage.ensure_user(uid)
+        _known_users.set(uid, True)
+
+class UserProfile(NamedTuple):
+    city: str | None
+    banned: int
+
+# Профили по tg_user_id: ограничены по размеру (LRU) и по времени (TTL), чтобы бан,
+# выставленный в обход бота, подхватывался не позже USER_CACHE_TTL
+user_profiles = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+@db_timed
+async def get_user(uid: int) -> UserProfile:
+    profile = user_profiles.get(uid)
+    if profile is _MISSING:
+        await ensure_user(uid)
+        row = await storage.get_user(uid)
+        profile = UserProfile(*row) if row else UserProfile(None, 0)
+        user_profiles.set(uid, profile)
+    return profile
+
+def invalidate_user(uid: int):
+    """Сбрасывает кэш профиля (например, после бана)."""
+    user_profiles.pop(uid)
+
+@db_timed
+async def set_city(uid: int, city: str):
+    row = await storage.set_city(uid, city)
+    _known_users.set(uid, True)
+    user_profiles.set(uid, UserProfile(*row))
+
+@db_timed
+async def _load_cities():
+    return await storage.cities()
+
+class CatalogPage(NamedTuple):
+    groups: list  # (name, anchor_id, variants, min_price, variant), anchor_id — MIN(id) группы,
+                  # variant — вариант, если он в группе единственный
+    has_prev: bool
+    has_next: bool
+
+@db_timed
+async def _load_catalog_page(key) -> CatalogPage:
+    city, direction, anchor = key
+    n = CATALOG_PAGE_SIZE
+    if direction == "<":
+        rows = await storage.catalog_page(city, "<", anchor, n + 1)
+        return CatalogPage(rows[:n][::-1], len(rows) > n, True)
+    if direction == ">":
+        rows = await storage.catalog_page(city, ">", anchor, n + 1)
+        return CatalogPage(rows[:n], True, len(rows) > n)
+    rows = await storage.catalog_page(city, ">=", anchor, n + 1)
+    has_prev = anchor != "" and await storage.has_names_before(city, anchor)
+    return CatalogPage(rows[:n], has_prev, len(rows) > n)
+
+@db_timed
+async def _load_group(key):
+    return await storage.product_group(*key)
+
+@db_timed
+async def _load_product(pid: int):
+    return await storage.product(pid)
+
+async def get_cities():
+    return await catalog_cache.get(catalog_cache.cities, None, lambda _: _load_cities())
+
+async def get_catalog_page(city: str, direction: str = "=", anchor: str = "") -> CatalogPage:
+    """direction: "=" — начиная с anchor, ">" — после anchor, "<" — до anchor."""
+    return await catalog_cache.get(catalog_cache.pages, (city, direction, anchor), _load_catalog_page)
+
+async def get_group(city: str, name: str):
+    return await catalog_cache.get(catalog_cache.groups, (city, name), _load_group)
+
+async def get_product(pid: int):
+    return await catalog_cache.get(catalog_cache.by_id, pid, _load_product)
+
+@db_timed
+async def create_order(uid: int, city: str, product_id: int, total: int,
+                       update_id: int | None = None, admin_notice=None) -> int:
+    """admin_notice(order_id) -> текст админу: пишется в outbox вместе с заказом, так что
+    падение между ними не теряет уведомление. Повтор апдейта update_id вернёт тот же заказ."""
+    created = now_ts()
+    reserved_until = created + RESERVE_MINUTES * 60
+    notice = (ADMIN_ID, admin_notice) if admin_notice is not None and ADMIN_ID else None
+    order_id, new = await storage.create_order(
+        uid, city, product_id, total, created, reserved_until, update_id, notice
+    )
+    if new:
+        expiry_scheduler.schedule(order_id, reserved_until)
+        if notice is not None:
+            notifier.wake()
+    return order_id
 
-async def maybe_expire(order_id: int, uid: int):
+@db_timed
+async def get_order(order_id: int, uid: int):
+    return await storage.get_order(order_id, uid)
+
+class OrderView(NamedTuple):
+    id: int
+    tg_user_id: int
+    city: str
+    product_id: int
+    name: str | None
+    variant: str | None
+    total_price: int
+    status: str
+    created_at: int
+    reserved_until: int
+    extends_count: int
+
+# Read-model заказов по id. Заказ меняют только переходы, продление и истечение
+# в этом же процессе (в режиме воркеров — у воркера его пользователя), и каждый
+# из них сбрасывает запись; TTL подхватывает правки в обход бота.
+order_views = TTLCache(ORDER_CACHE_SIZE, ORDER_CACHE_TTL)
+# растёт при каждом сбросе: чтение, начатое до него, не кладёт в кэш старую строку
+_order_views_epoch = 0
+
+def invalidate_order(order_id: int):
+    global _order_views_epoch
+    _order_views_epoch += 1
+    order_views.pop(order_id)
+
+@db_timed
+async def get_order_view(order_id: int, uid: int) -> OrderView | None:
+    view = order_views.get(order_id)
+    if view is _MISSING:
+        epoch = _order_views_epoch
+        row = await storage.order_view(order_id, uid)
+        if row is None:
+            return None
+        view = OrderView(*row)
+        if epoch == _order_views_epoch:
+            order_views.set(order_id, view)
+    return view if view.tg_user_id == uid else None
+
+@db_timed
+async def get_user_orders(uid: int, before: int | None = None,
+                          limit: int = MY_ORDERS_PAGE_SIZE) -> tuple[list[OrderView], bool]:
+    """Страница истории заказов (новые первыми) и признак, что есть ещё; заказы попадают в order_views."""
+    epoch = _order_views_epoch
+    rows = await storage.user_orders(uid, before, limit + 1)
+    views = [OrderView(*row) for row in rows[:limit]]
+    if epoch == _order_views_epoch:
+        for view in views:
+            order_views.set(view.id, view)
+    return views, len(rows) > limit
+
+# Допустимые переходы статусов заказа. Каждый переход — один условный UPDATE
+# (WHERE status IN ...), успех определяется по rowcount: если статус уже сменился
+# параллельным кликом, строка просто не обновится, без чтения перед записью.
+ORDER_TRANSITIONS = {
+    "AWAITING_PAYMENT": ("PAID_REPORTED", "EXPIRED", "CANCELLED"),
+    "PAID_REPORTED": ("COMPLETED", "CANCELLED"),
+    "EXPIRED": (),
+    "CANCELLED": (),
+    "COMPLETED": (),
+}
+_TRANSITION_SOURCES = {
+    target: tuple(src for src, targets in ORDER_TRANSITIONS.items() if target in targets)
+    for target in ORDER_TRANSITIONS
+}
+
+@db_timed
+async def transition_order(order_id: int, uid: int, to: str, admin_notice: str | None = None) -> bool:
+    """Переводит заказ в статус to; False, если заказ не найден или переход уже недопустим.
+    admin_notice пишется в outbox в одной транзакции с переходом."""
+    sources = _TRANSITION_SOURCES[to]
+    if not sources:
+        return False
+    notice = (ADMIN_ID, admin_notice) if admin_notice is not None and ADMIN_ID else None
+    ok = await storage.transition_order(order_id, uid, to, sources, now_ts(), notice)
+    # и при неудаче: значит, статус сменился без нас, и кэш уже устарел
+    invalidate_order(order_id)
+    if ok:
+        expiry_scheduler.discard(order_id)
+        if notice is not None:
+            notifier.wake()
+    return ok
+
+@db_timed
+async def extend_reserve(order_id: int, uid: int):
+    reserved_until = await storage.extend_reserve(order_id, uid, EXTEND_MINUTES * 60, MAX_EXTENDS, now_ts())
+    invalidate_order(order_id)
+    if reserved_until is not None:
+        expiry_scheduler.schedule(order_id, reserved_until)
+        return True, f"Бронь продлена на {EXTEND_MINUTES} мин."
+
+    # продление не прошло — только теперь читаем заказ, чтобы объяснить почему
     order = await get_order(order_id, uid)
     if not order:
-        return
-    _, _, _, _, status, _, reserved_until, _ = order
+        return False, "Заказ не найден."
+    _, _, _, _, status, _, reserved_until, extends_count = order
     if status != "AWAITING_PAYMENT":
+        return False, "Продлить можно только когда ожидается оплата."
+    if extends_count >= MAX_EXTENDS:
+        return False, "Лимит продления исчерпан."
+    return False, "Бронь уже истекла."
+
+# ----------------- ИСТЕЧЕНИЕ БРОНИ -----------------
+class ExpiryScheduler:
+    """Фоновый перевод просроченных заказов в EXPIRED.
+
+    Держит min-heap дедлайнов reserved_until (собирается из orders при старте,
+    пополняется create_order и extend_reserve) и просыпается к ближайшему.
+    Устаревшие записи кучи (после продления, оплаты или отмены) отбрасываются
+    лениво по словарю актуальных дедлайнов, так что таблица не сканируется.
+    В режиме воркеров shard=(index, count) оставляет воркеру только заказы его
+    пользователей: новые заказы этих пользователей создаёт он же.
+    """
+
+    def __init__(self, batch_size: int = EXPIRY_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.shard: tuple[int, int] | None = None
+        self._heap: list[tuple[int, int]] = []
+        self._deadlines: dict[int, int] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def schedule(self, order_id: int, ts: int):
+        self._deadlines[order_id] = ts
+        heapq.heappush(self._heap, (ts, order_id))
+        if self._heap[0][1] == order_id:
+            self._wakeup.set()
+
+    def discard(self, order_id: int):
+        self._deadlines.pop(order_id, None)
+
+    async def load(self):
+        rows = await storage.pending_reservations(self.shard)
+        self._deadlines = {oid: ts for oid, ts in rows}
+        self._heap = [(ts, oid) for oid, ts in self._deadlines.items()]
+        heapq.heapify(self._heap)
+        logging.info("✅ Expiry scheduler loaded %s pending reservations", len(self._heap))
+
+    async def start(self):
+        await self.load()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _pop_due(self, now: float) -> list[int]:
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            ts, oid = heapq.heappop(self._heap)
+            if self._deadlines.get(oid) == ts:
+                del self._deadlines[oid]
+                due.append(oid)
+        return due
+
+    async def _expire(self, order_ids: list[int]):
+        await storage.expire_orders(order_ids, now_ts())
+        for oid in order_ids:
+            invalidate_order(oid)
+
+    async def _run(self):
+        while True:
+            due = self._pop_due(time.time())
+            if due:
+                try:
+                    await self._expire(due)
+                except Exception:
+                    logging.exception("Expiry batch failed, retrying in %ss", EXPIRY_RETRY_SECONDS)
+                    retry_at = now_ts() + EXPIRY_RETRY_SECONDS
+                    for oid in due:
+                        self.schedule(oid, retry_at)
+                    await asyncio.sleep(EXPIRY_RETRY_SECONDS)
+                continue
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+expiry_scheduler = ExpiryScheduler()
+
+# ----------------- УВЕДОМЛЕНИЯ -----------------
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        self._refill()
+        while self._tokens < 1:
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+            self._refill()
+        self._tokens -= 1
+
+class Notifier:
+    """Исходящие уведомления из outbox: дайджест на чат, token bucket, повтор при ошибках."""
+
+    def __init__(self, rate: float = NOTIFY_RATE_PER_SEC, burst: int = NOTIFY_BURST,
+                 window: float = NOTIFY_DIGEST_SECONDS):
+        self.window = window
+        self.bucket = TokenBucket(rate, burst)
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def wake(self):
+        """Сообщения уже в outbox (записаны вместе с другим изменением) — пора отправлять."""
+        self._wakeup.set()
+
+    def start(self, bot: Bot, poll_interval: float | None = None):
+        # сразу будим: в outbox могли остаться сообщения с прошлого запуска;
+        # poll_interval нужен, когда в outbox пишут другие процессы
+        self._wakeup.set()
+        self._task = asyncio.create_task(self._run(bot, poll_interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @staticmethod
+    def _digests(rows) -> list[tuple[int, list[int], list[str]]]:
+        by_chat: dict[int, list[tuple[int, str]]] = {}
+        for row_id, chat_id, text in rows:
+            by_chat.setdefault(chat_id, []).append((row_id, text))
+        digests = []
+        for chat_id, items in by_chat.items():
+            ids, parts, size = [], [], 0
+            for row_id, text in items:
+                if parts and size + len(text) + 2 > TELEGRAM_TEXT_LIMIT:
+                    digests.append((chat_id, ids, parts))
+                    ids, parts, size = [], [], 0
+                ids.append(row_id)
+                parts.append(text[:TELEGRAM_TEXT_LIMIT])
+                size += len(parts[-1]) + 2
+            digests.append((chat_id, ids, parts))
+        return digests
+
+    async def _send(self, bot: Bot, chat_id: int, text: str) -> bool:
+        """False — Telegram отверг сам текст (400), повтор того же текста бесполезен."""
+        delay = 1.0
+        while True:
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(chat_id, text, parse_mode=None)
+                return True
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest:
+                return False
+            except TelegramForbiddenError:
+                logging.exception("Notification to %s dropped", chat_id)
+                return True
+            except Exception:
+                logging.warning("Notification to %s failed, retrying in %.0fs", chat_id, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, NOTIFY_MAX_BACKOFF_SECONDS)
+
+    async def _flush(self, bot: Bot) -> int:
+        rows = await storage.outbox_batch(NOTIFY_BATCH_SIZE)
+        for chat_id, ids, parts in self._digests(rows):
+            rejected = []
+            if not await self._send(bot, chat_id, "\n\n".join(parts)):
+                # одно отвергнутое сообщение не должно утянуть за собой весь дайджест
+                rejected = parts if len(parts) == 1 else [p for p in parts if not await self._send(bot, chat_id, p)]
+            for part in rejected:
+                logging.error("Notification to %s dropped, rejected by Telegram: %.200s", chat_id, part)
+            await storage.outbox_delete(ids)
+        return len(rows)
+
+    async def _run(self, bot: Bot, poll_interval: float | None):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await asyncio.sleep(self.window)
+            try:
+                if await self._flush(bot) == NOTIFY_BATCH_SIZE:
+                    self._wakeup.set()
+            except Exception:
+                logging.exception("Notification flush failed")
+                self._wakeup.set()
+
+notifier = Notifier()
+
+# ----------------- ЖУРНАЛ АПДЕЙТОВ -----------------
+class UpdateJournal(BaseMiddleware):
+    """Журнал апдейтов: отбрасывает повторы по update_id и доделывает незавершённые после падения."""
+
+    def __init__(self, flush_interval: float = JOURNAL_FLUSH_SECONDS,
+                 retention: int = JOURNAL_RETENTION_SECONDS, compact_interval: float = JOURNAL_COMPACT_SECONDS):
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.compact_interval = compact_interval
+        self.shard: tuple[int, int] | None = None
+        self._done: list[int] = []
+        self._replayed: set[int] = set()
+        self._task: asyncio.Task | None = None
+
+    async def __call__(self, handler, event: Update, data):
+        if not data.get("journaled"):
+            user = data.get("event_from_user")
+            payload = event.model_dump_json(by_alias=True, exclude_none=True)
+            if not await storage.journal_record(event.update_id, user.id if user else 0, payload, now_ts()):
+                return self._duplicate()
+        elif self._replayed and event.update_id in self._replayed:
+            self._replayed.discard(event.update_id)
+            return self._duplicate()
+        try:
+            return await handler(event, data)
+        finally:
+            # и после ошибки хендлера: повтор упавшего апдейта упал бы снова
+            self._done.append(event.update_id)
+
+    @staticmethod
+    def _duplicate():
+        if metrics.enabled:
+            metrics.inc("bot_updates_duplicate_total")
+        return None
+
+    async def record_raw(self, raw: dict) -> bool:
+        """Запись апдейта в ingest, до передачи воркеру; False — апдейт уже был."""
+        payload = json.dumps(raw, ensure_ascii=False)
+        if await storage.journal_record(raw["update_id"], update_user_id(raw), payload, now_ts()):
+            return True
+        self._duplicate()
+        return False
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def flush(self):
+        while self._done:
+            ids, self._done = self._done[:JOURNAL_BATCH_SIZE], self._done[JOURNAL_BATCH_SIZE:]
+            try:
+                await storage.journal_done(ids, now_ts())
+            except BaseException:
+                self._done[:0] = ids
+                raise
+
+    async def compact(self) -> int:
+        removed = 0
+        done_before = now_ts() - self.retention
+        while True:
+            n = await storage.journal_compact(done_before, JOURNAL_BATCH_SIZE)
+            removed += n
+            if n < JOURNAL_BATCH_SIZE:
+                return removed
+
+    async def replay(self, bot: Bot, dp: Dispatcher) -> int:
+        """Прогоняет незавершённые апдейты (своего shard) по порядку update_id."""
+        rows = await storage.journal_pending(self.shard)
+        for update_id, payload in rows:
+            try:
+                update = Update.model_validate_json(payload, context={"bot": bot})
+                await dp.feed_update(bot, update, journaled=True)
+            except Exception:
+                logging.exception("Replay of update %s failed", update_id)
+                self._done.append(update_id)
+            # ingest мог записать апдейт, но не успеть отдать его прошлому воркеру
+            self._replayed.add(update_id)
+        if metrics.enabled and rows:
+            metrics.inc("bot_updates_replayed_total", value=len(rows))
+        await self.flush()
+        if rows:
+            logging.info("✅ Update journal: replayed %s unfinished updates", len(rows))
+        return len(rows)
+
+    async def _run(self):
+        next_compact = time.monotonic() + self.compact_interval
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() >= next_compact:
+                    next_compact = time.monotonic() + self.compact_interval
+                    removed = await self.compact()
+                    if removed:
+                        logging.info("Update journal compacted: %s entries", removed)
+            except Exception:
+                logging.exception("Update journal flush failed")
+
+update_journal = UpdateJournal()
+
+# ----------------- КЭШ КАТАЛОГА -----------------
+class CatalogCache:
+    """Read-through кэш каталога: список городов, страницы каталога, варианты
+    товара по (город, название) и товар по id.
+
+    Каталог меняется только через /addproduct и импорт, поэтому кэш живёт до
+    явного invalidate(). version растёт при каждой инвалидации, чтобы загрузка,
+    начатая до неё, не положила в кэш устаревшие строки.
+
+    Когда процессов несколько, изменивший каталог вызывает publish(): он
+    поднимает общую версию в cache_versions, а остальные видят её через
+    фоновую сверку start_sync() и сбрасывают свой кэш.
+    """
+
+    SECTIONS = ("cities", "pages", "groups", "by_id")
+
+    def __init__(self, max_pages: int, max_products: int):
+        self.version = 0
+        self.cities = LRUCache(1)
+        self.pages = LRUCache(max_pages)
+        self.groups = LRUCache(max_pages)
+        self.by_id = LRUCache(max_products)
+        self._shared_version: int | None = None
+        self._sync_task: asyncio.Task | None = None
+
+    async def get(self, section: LRUCache, key, loader):
+        value = section.get(key)
+        if value is _MISSING:
+            version = self.version
+            value = await loader(key)
+            if version == self.version:
+                section.set(key, value)
+        return value
+
+    def invalidate(self):
+        self.version += 1
+        for section in self.SECTIONS:
+            getattr(self, section).clear()
+
+    async def publish(self):
+        self.invalidate()
+        await storage.bump_cache_version("catalog")
+
+    async def _shared(self) -> int:
+        return await storage.cache_version("catalog")
+
+    def start_sync(self, interval: float = CACHE_SYNC_SECONDS):
+        async def run():
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    shared = await self._shared()
+                except Exception:
+                    logging.exception("Catalog version check failed")
+                    continue
+                if shared != self._shared_version:
+                    self._shared_version = shared
+                    self.invalidate()
+        self._sync_task = asyncio.create_task(run())
+
+    async def stop_sync(self):
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            try:
+                await self._sync_task
+            except asyncio.CancelledError:
+                pass
+            self._sync_task = None
+
+    async def warm(self):
+        """Загружает города, первые страницы городов и их клавиатуры; запросы идут
+        параллельно по читателям пула, а не один за другим."""
+        self.invalidate()
+        self._shared_version, cities, rows = await asyncio.gather(
+            self._shared(), get_cities(), storage.products_head(self.by_id.maxsize)
+        )
+        for row in rows:
+            self.by_id.set(row[0], row)
+        kb_cities(cities)
+        cities = cities[:self.pages.maxsize]
+        pages = await asyncio.gather(*(get_catalog_page(city) for city in cities))
+        for city, page in zip(cities, pages):
+            kb_catalog_page(city, page)
+        logging.info("✅ Catalog cache warmed: %s cities, %s products", len(cities), len(self.by_id))
+
+    def stats(self) -> dict:
+        stats = {"version": self.version}
+        for section in self.SECTIONS:
+            stats[section] = getattr(self, section).stats()
+        return stats
+
+catalog_cache = CatalogCache(CATALOG_CACHE_PAGES, CATALOG_CACHE_PRODUCTS)
+
+# ----------------- ИМПОРТ / ЭКСПОРТ КАТАЛОГА -----------------
+CATALOG_COLUMNS = ("city", "name", "variant", "price", "description")
+
+class ImportResult(NamedTuple):
+    imported: int
+    errors: int
+    first_errors: list[str]
+
+def _catalog_records(stream, fmt: str):
+    """Построчно отдаёт (номер строки, dict) из CSV или JSON Lines, не читая файл целиком."""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
         return
-    ru = datetime.fromisoformat(reserved_until)
-    if now_utc() > ru:
-        await set_order_status(order_id, uid, "EXPIRED")
+    for line_no, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_no, e
+            continue
+        yield line_no, record
+
+def _validate_product(record) -> tuple:
+    if not isinstance(record, dict):
+        raise ValueError("ожидался объект с полями " + ", ".join(CATALOG_COLUMNS))
+    city, name, variant = (str(record.get(k) or "").strip() for k in ("city", "name", "variant"))
+    if not (city and name and variant):
+        raise ValueError("пустые city/name/variant")
+    price = int(str(record.get("price", "")).strip())
+    if price < 0:
+        raise ValueError("отрицательная цена")
+    return city, name, variant, price, str(record.get("description") or "").strip()
+
+def catalog_format(filename: str) -> str:
+    return "csv" if filename.lower().endswith(".csv") else "jsonl"
+
+async def import_products(path: str, fmt: str | None = None) -> ImportResult:
+    """Потоковый импорт каталога: upsert пачками по IMPORT_CHUNK_SIZE строк,
+    одна инвалидация кэша каталога в конце."""
+    fmt = fmt or catalog_format(path)
+    imported, errors, first_errors = 0, 0, []
+    chunk = []
+    try:
+        with open(path, encoding="utf-8-sig", newline="") as stream:
+            for line_no, record in _catalog_records(stream, fmt):
+                try:
+                    if isinstance(record, Exception):
+                        raise record
+                    chunk.append(_validate_product(record))
+                except (ValueError, TypeError) as e:
+                    errors += 1
+                    if len(first_errors) < 5:
+                        first_errors.append(f"строка {line_no}: {e}")
+                    continue
+                if len(chunk) >= IMPORT_CHUNK_SIZE:
+                    await storage.upsert_products(chunk)
+                    imported += len(chunk)
+                    chunk = []
+            if chunk:
+                await storage.upsert_products(chunk)
+                imported += len(chunk)
+    finally:
+        if imported:
+            await catalog_cache.publish()
+    logging.info("✅ Catalog import %s: %s rows, %s errors", path, imported, errors)
+    return ImportResult(imported, errors, first_errors)
+
+async def export_products(path: str) -> int:
+    """Потоковый экспорт каталога в CSV с теми же колонками, что принимает импорт."""
+    count = 0
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(CATALOG_COLUMNS)
+        async for rows in storage.stream_products():
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+# ----------------- ОТЧЁТЫ ПО ЗАКАЗАМ -----------------
+class OrderPage(NamedTuple):
+    rows: list
+    next_cursor: str | None
+
+def order_filter(args) -> OrderFilter:
+    """Фильтр из аргументов команды или query-строки: status, city, days, since, until (epoch)."""
+    status = (args.get("status") or "").upper() or None
+    if status is not None and status not in ORDER_TRANSITIONS:
+        raise ValueError(f"Неизвестный статус: {status}")
+    since = int(args["since"]) if args.get("since") else None
+    until = int(args["until"]) if args.get("until") else None
+    if args.get("days"):
+        since = now_ts() - int(float(args["days"]) * 86400)
+    return OrderFilter(status, args.get("city") or None, since, until)
+
+@db_timed
+async def list_orders(f: OrderFilter, cursor: str | None = None, limit: int = ADMIN_PAGE_SIZE) -> OrderPage:
+    """Страница заказов, новые первыми; cursor — «created_at:id» последней строки предыдущей страницы."""
+    if cursor:
+        created_at, order_id = cursor.split(":", 1)
+        cursor = (int(created_at), int(order_id))
+    rows = await storage.list_orders(f, cursor, limit + 1)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1][6]}:{rows[-1][0]}"
+    return OrderPage(rows, next_cursor)
+
+def _summarize(by_status: dict[str, tuple[int, int]]) -> dict:
+    total = sum(n for n, _ in by_status.values())
+    paid = sum(by_status.get(st, (0, 0))[0] for st in ("PAID_REPORTED", "COMPLETED"))
+    return {
+        "orders": total,
+        "by_status": {st: n for st, (n, _) in sorted(by_status.items())},
+        "revenue": by_status.get("COMPLETED", (0, 0))[1],
+        "pending_revenue": by_status.get("PAID_REPORTED", (0, 0))[1],
+        "conversion": round(paid / total, 4) if total else 0.0,
+    }
 
-async def extend_reserve(order_id: int, uid: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT status, reserved_until, extends_count
-            FROM orders WHERE id=? AND tg_user_id=?
-        """, (order_id, uid))
-        row = await cur.fetchone()
-        if not row:
-            return False, "Заказ не найден."
-        status, reserved_until, extends_count = row
-        if status != "AWAITING_PAYMENT":
-            return False, "Продлить можно только когда ожидается оплата."
-        if extends_count >= MAX_EXTENDS:
-            return False, "Лимит продления исчерпан."
-        ru = datetime.fromisoformat(reserved_until)
-        if now_utc() > ru:
-            return False, "Бронь уже истекла."
-        new_ru = ru + timedelta(minutes=EXTEND_MINUTES)
-        await db.execute("""
-            UPDATE orders SET reserved_until=?, extends_count=extends_count+1
-            WHERE id=? AND tg_user_id=?
-        """, (new_ru.isoformat(), order_id, uid))
-        await db.commit()
-        return True, f"Бронь продлена на {EXTEND_MINUTES} мин."
+@db_timed
+async def order_summary(f: OrderFilter) -> dict:
+    """Выручка и конверсия из order_stats с точностью до UTC-суток; фильтр по статусу игнорируется."""
+    first_day = f.since // 86400 if f.since is not None else 0
+    last_day = (f.until - 1) // 86400 if f.until is not None else now_ts() // 86400
+    # строк здесь дни × города × статусы; свёртка в Python дешевле GROUP BY через temp b-tree
+
+    totals: dict[str, tuple[int, int]] = {}
+    by_city: dict[str, dict[str, tuple[int, int]]] = {}
+    async for rows in storage.stream_order_stats(first_day, last_day, f.city):
+        for city, status, n, revenue in rows:
+            if not n:
+                continue
+            for acc in (totals, by_city.setdefault(city, {})):
+                a_n, a_rev = acc.get(status, (0, 0))
+                acc[status] = (a_n + n, a_rev + revenue)
+    return {
+        "since": f.since,
+        "until": f.until,
+        "totals": _summarize(totals),
+        "by_city": {city: _summarize(st) for city, st in sorted(by_city.items())},
+    }
+
+async def iter_orders_csv(f: OrderFilter):
+    """CSV заказов кусками по DB_STREAM_CHUNK строк: в памяти не больше одной пачки."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(ORDER_COLUMNS)
+    async for rows in storage.stream_orders(f):
+        writer.writerows(rows)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+async def export_orders(path: str, f: OrderFilter) -> int:
+    count = 0
+    with open(path, "w", encoding="utf-8", newline="") as out:
+        writer = csv.writer(out)
+        writer.writerow(ORDER_COLUMNS)
+        async for rows in storage.stream_orders(f):
+            writer.writerows(rows)
+            count += len(rows)
+    return count
 
 # ----------------- КНОПКИ -----------------
+def _kb_rows(buttons) -> InlineKeyboardMarkup:
+    # по одной кнопке в ряд, как adjust(1), но без InlineKeyboardBuilder
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=text, callback_data=data)] for text, data in buttons
+    ])
+
+def _kb_template(template, value) -> InlineKeyboardMarkup:
+    # тексты статичны, в callback_data подставляется только id
+    return _kb_rows((text, data.format(value)) for text, data in template)
+
+_KB_BACK_MENU = ("⬅️ Меню", "menu")
+
+KB_MAIN = _kb_rows((
+    ("🏙 Выбрать город", "pick_city"),
+    ("🛒 Каталог", "catalog"),
+    ("📦 Статус последнего заказа", "last_status"),
+    ("🧾 Мои заказы", "my_orders"),
+    ("🆘 Поддержка", "support"),
+))
+
+_KB_PRODUCT_TEMPLATE = (
+    ("✅ Заказать", "order:{}"),
+    ("⬅️ Каталог", "catalog"),
+)
+
+_KB_ORDER_TEMPLATE = (
+    ("💳 Оплата картой", "pay:card:{}"),
+    ("💰 Другая оплата", "pay:other:{}"),
+    ("✅ Я оплатил(а)", "paid:{}"),
+    ("📌 Статус", "status:{}"),
+    ("⏳ Продлить бронь", "extend:{}"),
+    ("❌ Отменить заказ", "cancel:{}"),
+    _KB_BACK_MENU,
+)
+
+# клавиатуры городов и каталога: ключ — сами отображаемые данные, поэтому
+# список, загруженный до инвалидации, не выдаётся за новую версию;
+# смена версии лишь освобождает память от старых разметок
+_kb_catalog_cache = LRUCache(2 * CATALOG_CACHE_PAGES + 1)
+_kb_catalog_version = 0
+
+def _kb_cached(key, build) -> InlineKeyboardMarkup:
+    global _kb_catalog_version
+    if _kb_catalog_version != catalog_cache.version:
+        _kb_catalog_cache.clear()
+        _kb_catalog_version = catalog_cache.version
+    markup = _kb_catalog_cache.get(key)
+    if markup is _MISSING:
+        markup = build()
+        _kb_catalog_cache.set(key, markup)
+    return markup
+
 def kb_main():
-    b = InlineKeyboardBuilder()
-    b.button(text="🏙 Выбрать город", callback_data="pick_city")
-    b.button(text="🛒 Каталог", callback_data="catalog")
-    b.button(text="📦 Статус последнего заказа", callback_data="last_status")
-    b.button(text="🆘 Поддержка", callback_data="support")
-    b.adjust(1)
-    return b.as_markup()
+    return KB_MAIN
 
 def kb_cities(cities: list[str]):
-    b = InlineKeyboardBuilder()
-    for c in cities:
-        b.button(text=c, callback_data=f"city:{c}")
-    b.button(text="⬅️ Меню", callback_data="menu")
-    b.adjust(1)
-    return b.as_markup()
-
-def kb_catalog(items):
-    b = InlineKeyboardBuilder()
-    for pid, name, variant, price in items:
-        b.button(text=f"{name} • {variant} — {price} грн", callback_data=f"prod:{pid}")
-    b.button(text="⬅️ Меню", callback_data="menu")
-    b.adjust(1)
-    return b.as_markup()
+    return _kb_cached(("cities", tuple(cities)), lambda: _kb_rows(
+        [(c, f"city:{c}") for c in cities] + [_KB_BACK_MENU]
+    ))
+
+def catalog_cb(cursor: str) -> str:
+    # город берётся из товара-якоря: callback_data (<= 64 байт) не зависит от длины названия города
+    return f"catalog:{cursor}"
+
+def kb_catalog_page(city: str, page: CatalogPage):
+    def build():
+        rows = []
+        for name, anchor_id, variants, min_price, variant in page.groups:
+            if variants == 1:
+                rows.append([InlineKeyboardButton(
+                    text=f"{name} • {variant} — {min_price} грн", callback_data=f"prod:{anchor_id}"
+                )])
+            else:
+                rows.append([InlineKeyboardButton(
+                    text=f"{name} — от {min_price} грн ({variants})", callback_data=f"grp:{anchor_id}"
+                )])
+        nav = []
+        if page.has_prev and page.groups:
+            nav.append(InlineKeyboardButton(text="◀️", callback_data=catalog_cb(f"<{page.groups[0][1]}")))
+        if page.has_next and page.groups:
+            nav.append(InlineKeyboardButton(text="▶️", callback_data=catalog_cb(f">{page.groups[-1][1]}")))
+        if nav:
+            rows.append(nav)
+        rows.append([InlineKeyboardButton(text=_KB_BACK_MENU[0], callback_data=_KB_BACK_MENU[1])])
+        return InlineKeyboardMarkup(inline_keyboard=rows)
+    return _kb_cached(("page", city, tuple(map(tuple, page.groups)), page.has_prev, page.has_next), build)
+
+def kb_group(city: str, name: str, anchor_id: int, variants):
+    return _kb_cached(("group", city, name, anchor_id, tuple(map(tuple, variants))), lambda: _kb_rows(
+        [(f"{name} • {variant} — {price} грн", f"prod:{pid}") for pid, variant, price in variants]
+        + [("⬅️ Каталог", catalog_cb(f"={anchor_id}"))]
+    ))
 
 def kb_product(pid: int):
-    b = InlineKeyboardBuilder()
-    b.button(text="✅ Заказать", callback_data=f"order:{pid}")
-    b.button(text="⬅️ Каталог", callback_data="catalog")
-    b.adjust(1)
-    return b.as_markup()
+    return _kb_template(_KB_PRODUCT_TEMPLATE, pid)
 
 def kb_order(order_id: int):
-    b = InlineKeyboardBuilder()
-    b.button(text="💳 Оплата картой", callback_data=f"pay:card:{order_id}")
-    b.button(text="💰 Другая оплата", callback_data=f"pay:other:{order_id}")
-    b.button(text="✅ Я оплатил(а)", callback_data=f"paid:{order_id}")
-    b.button(text="📌 Статус", callback_data=f"status:{order_id}")
-    b.button(text="⏳ Продлить бронь", callback_data=f"extend:{order_id}")
-    b.button(text="❌ Отменить заказ", callback_data=f"cancel:{order_id}")
-    b.button(text="⬅️ Меню", callback_data="menu")
-    b.adjust(1)
-    return b.as_markup()
+    return _kb_template(_KB_ORDER_TEMPLATE, order_id)
+
+def kb_my_orders(views: list, has_more: bool):
+    rows = [
+        [InlineKeyboardButton(
+            text=f"№{v.id} · {v.name or 'Товар'} · {STATUS_LABELS.get(v.status, v.status)}",
+            callback_data=f"status:{v.id}",
+        )]
+        for v in views
+    ]
+    if has_more:
+        rows.append([InlineKeyboardButton(text="▶️ Ранее", callback_data=f"my_orders:{views[-1].id}")])
+    rows.append([InlineKeyboardButton(text=_KB_BACK_MENU[0], callback_data=_KB_BACK_MENU[1])])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
 
 # ----------------- BOT -----------------
 router = Router()
 
+STATUS_LABELS = {
+    "AWAITING_PAYMENT": "Ожидается оплата",
+    "PAID_REPORTED": "Оплата заявлена",
+    "EXPIRED": "Бронь истекла",
+    "CANCELLED": "Отменён",
+    "COMPLETED": "Завершён",
+}
+# тексты статуса по версии заказа; старые версии вытесняются LRU
+_status_texts = LRUCache(ORDER_CACHE_SIZE)
+
+class UserProfileMiddleware(BaseMiddleware):
+    """Кладёт профиль пользователя в kwargs хендлера как `profile`.
+
+    Профиль грузится только для хендлеров, у которых есть параметр profile,
+    остальные не платят за lookup.
+    """
+
+    async def __call__(self, handler, event, data):
+        wanted = data.get("handler")
+        user = data.get("event_from_user")
+        if user is not None and wanted is not None and "profile" in wanted.params:
+            data["profile"] = await get_user(user.id)
+        return await handler(event, data)
+
+class CallbackGuardMiddleware(BaseMiddleware):
+    """Троттлинг и дедупликация нажатий кнопок до запуска хендлера.
+
+    На пользователя — token bucket (rate нажатий в секунду, не больше burst
+    подряд), хранится кортежем (tokens, updated) в LRU, а не объектом. Повтор
+    того же callback_data в пределах dedup_window просто гасит «часики».
+    Для префиксов из IDEMPOTENT результат хендлера (id заказа) запоминается, и
+    повторный order:<pid> показывает ещё не оплаченный заказ вместо нового.
+    Все три структуры ограничены maxsize, так что память не растёт с числом
+    пользователей.
+    """
+
+    IDEMPOTENT = ("order:",)
+
+    def __init__(self, rate: float = THROTTLE_RATE_PER_SEC, burst: float = THROTTLE_BURST,
+                 dedup_window: float = CALLBACK_DEDUP_SECONDS, maxsize: int = CALLBACK_GUARD_USERS):
+        self.rate = rate
+        self.burst = burst
+        self.dedup_window = dedup_window
+        self._buckets = LRUCache(maxsize)
+        self._recent = LRUCache(maxsize)
+        self.results = TTLCache(maxsize, RESERVE_MINUTES * 60)
+
+    def _allow(self, uid: int, now: float) -> bool:
+        tokens, updated = self._buckets.get(uid, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        self._buckets.set(uid, (tokens - 1 if allowed else tokens, now))
+        return allowed
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if not isinstance(event, CallbackQuery) or user is None or not event.data:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        key = (user.id, event.data)
+        last = self._recent.get(key, None)
+        if last is not None and now - last < self.dedup_window:
+            metrics.inc("bot_callbacks_dropped_total", (("reason", "duplicate"),))
+            await event.answer()
+            return None
+        if not self._allow(user.id, now):
+            metrics.inc("bot_callbacks_dropped_total", (("reason", "throttled"),))
+            await event.answer("⏳ Слишком часто, подождите секунду.")
+            return None
+        self._recent.set(key, now)
+
+        idempotent = event.data.startswith(self.IDEMPOTENT)
+        if idempotent:
+            order_id = self.results.get(key, None)
+            if order_id is not None:
+                view = await get_order_view(order_id, user.id)
+                if view and view.status == "AWAITING_PAYMENT":
+                    metrics.inc("bot_callbacks_dropped_total", (("reason", "idempotent"),))
+                    await show_status(event, order_id, "У вас уже есть неоплаченный заказ на этот товар.")
+                    return None
+                self.results.pop(key)
+
+        result = await handler(event, data)
+        if idempotent and isinstance(result, int):
+            self.results.set(key, result)
+        return result
+
+callback_guard = CallbackGuardMiddleware()
+
+if metrics.enabled:
+    router.message.middleware(HandlerMetricsMiddleware())
+    router.callback_query.middleware(HandlerMetricsMiddleware())
+router.callback_query.middleware(callback_guard)
+router.message.middleware(UserProfileMiddleware())
+router.callback_query.middleware(UserProfileMiddleware())
+
 @router.message(Command("start"))
 async def start(m: Message):
     await ensure_user(m.from_user.id)
@@ -279,15 +2400,20 @@ async def pick_city(c: CallbackQuery):
 @router.callback_query(F.data.startswith("city:"))
 async def set_city_cb(c: CallbackQuery):
     city = c.data.split(":", 1)[1]
-    await ensure_user(c.from_user.id)
     await set_city(c.from_user.id, city)
     await c.message.edit_text(f"✅ Город выбран: <b>{city}</b>\nОткройте каталог.", reply_markup=kb_main())
     await c.answer()
 
+async def show_catalog_page(c: CallbackQuery, city: str, direction: str = "=", anchor: str = ""):
+    page = await get_catalog_page(city, direction, anchor)
+    await c.message.edit_text(
+        f"🛒 Каталог • <b>{city}</b>:", reply_markup=kb_catalog_page(city, page)
+    )
+    await c.answer()
+
 @router.callback_query(F.data == "catalog")
-async def catalog(c: CallbackQuery):
-    await ensure_user(c.from_user.id)
-    city, banned = await get_user(c.from_user.id)
+async def catalog(c: CallbackQuery, profile: UserProfile):
+    city, banned = profile
     if banned:
         await c.message.edit_text("⛔️ У вас бан. Напишите в поддержку.", reply_markup=kb_main())
         await c.answer()
@@ -296,8 +2422,34 @@ async def catalog(c: CallbackQuery):
         await c.message.edit_text("Сначала выберите город:", reply_markup=kb_cities(await get_cities()))
         await c.answer()
         return
-    items = await get_products_by_city(city)
-    await c.message.edit_text(f"🛒 Каталог • <b>{city}</b>:", reply_markup=kb_catalog(items))
+    await show_catalog_page(c, city)
+
+@router.callback_query(F.data.startswith("catalog:"))
+async def catalog_page(c: CallbackQuery, profile: UserProfile):
+    if profile.banned:
+        await c.answer("Вы заблокированы.", show_alert=True)
+        return
+    # catalog:<курсор>, курсор = направление (= > <) + id товара-якоря группы; город — город якоря.
+    # Кнопки старого формата catalog:<город>:<курсор> разбираются так же
+    cursor = c.data.rsplit(":", 1)[1]
+    p = await get_product(int(cursor[1:])) if cursor[:1] in ("=", "<", ">") and cursor[1:].isdigit() else None
+    if p is None:
+        # якорь удалён из каталога — первая страница города из профиля
+        await catalog(c, profile)
+        return
+    await show_catalog_page(c, p[1], cursor[0], p[2])
+
+@router.callback_query(F.data.startswith("grp:"))
+async def group(c: CallbackQuery):
+    pid = int(c.data.split(":", 1)[1])
+    p = await get_product(pid)
+    if not p:
+        await c.answer("Товар не найден", show_alert=True)
+        return
+    _id, city, name = p[:3]
+    variants = await get_group(city, name)
+    await c.message.edit_text(f"📦 <b>{name}</b> • {city}\nВыберите вариант:",
+                              reply_markup=kb_group(city, name, pid, variants))
     await c.answer()
 
 @router.callback_query(F.data.startswith("prod:"))
@@ -319,9 +2471,8 @@ async def prod(c: CallbackQuery):
     await c.answer()
 
 @router.callback_query(F.data.startswith("order:"))
-async def order(c: CallbackQuery, bot: Bot):
-    await ensure_user(c.from_user.id)
-    city, banned = await get_user(c.from_user.id)
+async def order(c: CallbackQuery, profile: UserProfile, event_update: Update):
+    city, banned = profile
     if banned:
         await c.answer("Вы заблокированы.", show_alert=True)
         return
@@ -340,7 +2491,19 @@ async def order(c: CallbackQuery, bot: Bot):
         await c.answer("Товар из другого города.", show_alert=True)
         return
 
-    order_id = await create_order(c.from_user.id, city, pid, price)
+    uid = c.from_user.id
+    order_id = await create_order(
+        uid, city, pid, price, update_id=event_update.update_id,
+        admin_notice=lambda oid: (
+            "🆕 Новый заказ\n"
+            f"Заказ № {oid}\n"
+            f"User id: {uid}\n"
+            f"Город: {city}\n"
+            f"Товар: {name} ({variant})\n"
+            f"Сумма: {price} грн\n"
+            "Статус: AWAITING_PAYMENT"
+        ),
+    )
 
     text = (
         "✅ Заказ создан!\n\n"
@@ -353,134 +2516,118 @@ async def order(c: CallbackQuery, bot: Bot):
     )
     await c.message.edit_text(text, reply_markup=kb_order(order_id))
     await c.answer()
-
-    if ADMIN_ID:
-        try:
-            await bot.send_message(
-                ADMIN_ID,
-                (
-                    "🆕 Новый заказ\n"
-                    f"Заказ № {order_id}\n"
-                    f"User id: {c.from_user.id}\n"
-                    f"Город: {city}\n"
-                    f"Товар: {name} ({variant})\n"
-                    f"Сумма: {price} грн\n"
-                    "Статус: AWAITING_PAYMENT"
-                )
-            )
-        except Exception:
-            pass
+    return order_id
 
 @router.callback_query(F.data.startswith("pay:"))
 async def pay(c: CallbackQuery):
     _, method, order_id_s = c.data.split(":")
     order_id = int(order_id_s)
 
-    await maybe_expire(order_id, c.from_user.id)
-    order = await get_order(order_id, c.from_user.id)
-    if not order:
+    view = await get_order_view(order_id, c.from_user.id)
+    if not view:
         await c.answer("Заказ не найден", show_alert=True)
         return
 
-    oid, _city, _pid, total, status, _created, reserved_until, extends = order
-    if status == "EXPIRED":
+    if view.status == "EXPIRED":
         await c.message.edit_text("⏰ Бронь истекла. Создайте новый заказ.", reply_markup=kb_main())
         await c.answer()
         return
 
-    ru = datetime.fromisoformat(reserved_until)
-    mins_left = max(0, int((ru - now_utc()).total_seconds() // 60))
+    mins_left = max(0, (view.reserved_until - now_ts()) // 60)
     pay_text = PAYMENT_CARD_TEXT if method == "card" else PAYMENT_OTHER_TEXT
 
     text = (
-        f"🧾 Заказ № <b>{oid}</b>\n"
-        f"💵 К оплате: <b>{total} грн</b>\n"
+        f"🧾 Заказ № <b>{view.id}</b>\n"
+        f"💵 К оплате: <b>{view.total_price} грн</b>\n"
         f"⏳ Осталось по брони: <b>{mins_left} мин</b>\n"
-        f"🔁 Продлений: <b>{extends}/{MAX_EXTENDS}</b>\n\n"
+        f"🔁 Продлений: <b>{view.extends_count}/{MAX_EXTENDS}</b>\n\n"
         f"{pay_text}"
     )
     await c.message.edit_text(text, reply_markup=kb_order(order_id))
     await c.answer()
 
 @router.callback_query(F.data.startswith("paid:"))
-async def paid(c: CallbackQuery, bot: Bot):
+async def paid(c: CallbackQuery):
     order_id = int(c.data.split(":", 1)[1])
-    await set_order_status(order_id, c.from_user.id, "PAID_REPORTED")
+    notice = f"✅ Клиент отметил оплату. Заказ № {order_id}. User {c.from_user.id}"
+    if not await transition_order(order_id, c.from_user.id, "PAID_REPORTED", admin_notice=notice):
+        await show_status(c, order_id, "Отметить оплату для этого заказа уже нельзя.")
+        return
     await c.message.edit_text("✅ Отметка об оплате получена. Ожидайте подтверждения.", reply_markup=kb_order(order_id))
     await c.answer()
 
-    if ADMIN_ID:
-        try:
-            await bot.send_message(ADMIN_ID, f"✅ Клиент отметил оплату. Заказ № {order_id}. User {c.from_user.id}")
-        except Exception:
-            pass
+def render_status(view: OrderView) -> str:
+    """Текст экрана статуса. Всё, кроме оставшихся минут брони, зависит только
+    от версии заказа (самого OrderView) и кэшируется по ней."""
+    text = _status_texts.get(view)
+    if text is _MISSING:
+        text = (
+            f"📌 Статус заказа № <b>{view.id}</b>\n\n"
+            f"🏙 Город: <b>{view.city}</b>\n"
+            f"📦 Товар: <b>{view.name or 'Товар'}</b> — {view.variant or ''}\n"
+            f"💵 Сумма: <b>{view.total_price} грн</b>\n"
+            f"🕒 Создан: {format_ts(view.created_at)}\n"
+            f"📍 Статус: <b>{STATUS_LABELS.get(view.status, view.status)}</b>\n"
+        )
+        _status_texts.set(view, text)
+    if view.status == "AWAITING_PAYMENT":
+        mins_left = max(0, (view.reserved_until - now_ts()) // 60)
+        text += (
+            f"⏳ Осталось по брони: <b>{mins_left} мин</b>\n"
+            f"🔁 Продлений: <b>{view.extends_count}/{MAX_EXTENDS}</b>\n"
+        )
+    return text
 
-@router.callback_query(F.data.startswith("status:"))
-async def status(c: CallbackQuery):
-    order_id = int(c.data.split(":", 1)[1])
-    await maybe_expire(order_id, c.from_user.id)
-    order = await get_order(order_id, c.from_user.id)
-    if not order:
+async def show_status(c: CallbackQuery, order_id: int, notice: str | None = None):
+    view = await get_order_view(order_id, c.from_user.id)
+    if not view:
         await c.answer("Заказ не найден", show_alert=True)
         return
+    await c.message.edit_text(render_status(view), reply_markup=kb_order(order_id))
+    await c.answer(notice, show_alert=notice is not None)
 
-    oid, city, pid, total, status_val, created_at, reserved_until, extends = order
-    p = await get_product(pid)
-    name = p[2] if p else "Товар"
-    variant = p[3] if p else ""
-
-    status_map = {
-        "AWAITING_PAYMENT": "Ожидается оплата",
-        "PAID_REPORTED": "Оплата заявлена",
-        "EXPIRED": "Бронь истекла",
-        "CANCELLED": "Отменён",
-        "COMPLETED": "Завершён",
-    }
-
-    ru = datetime.fromisoformat(reserved_until)
-    mins_left = int((ru - now_utc()).total_seconds() // 60)
-
-    text = (
-        f"📌 Статус заказа № <b>{oid}</b>\n\n"
-        f"🏙 Город: <b>{city}</b>\n"
-        f"📦 Товар: <b>{name}</b> — {variant}\n"
-        f"💵 Сумма: <b>{total} грн</b>\n"
-        f"🕒 Создан: {created_at}\n"
-        f"📍 Статус: <b>{status_map.get(status_val, status_val)}</b>\n"
-    )
-    if status_val == "AWAITING_PAYMENT":
-        text += f"⏳ Осталось по брони: <b>{max(0, mins_left)} мин</b>\n"
-        text += f"🔁 Продлений: <b>{extends}/{MAX_EXTENDS}</b>\n"
-
-    await c.message.edit_text(text, reply_markup=kb_order(order_id))
-    await c.answer()
+@router.callback_query(F.data.startswith("status:"))
+async def status(c: CallbackQuery):
+    await show_status(c, int(c.data.split(":", 1)[1]))
 
 @router.callback_query(F.data == "last_status")
 async def last_status(c: CallbackQuery):
-    last_id = await get_last_order_id(c.from_user.id)
-    if not last_id:
+    # последний заказ — первая строка истории; show_status возьмёт его из order_views
+    views, _ = await get_user_orders(c.from_user.id, limit=1)
+    if not views:
         await c.message.edit_text("У вас ещё нет заказов.", reply_markup=kb_main())
         await c.answer()
         return
-    c.data = f"status:{last_id}"
-    await status(c)
+    await show_status(c, views[0].id)
+
+@router.callback_query(F.data.startswith("my_orders"))
+async def my_orders(c: CallbackQuery):
+    _, _, before = c.data.partition(":")
+    views, has_more = await get_user_orders(c.from_user.id, int(before) if before else None)
+    if not views:
+        await c.message.edit_text("У вас ещё нет заказов.", reply_markup=kb_main())
+        await c.answer()
+        return
+    title = "🧾 Ваши заказы" if not before else "🧾 Ваши заказы (ранее)"
+    await c.message.edit_text(title, reply_markup=kb_my_orders(views, has_more))
+    await c.answer()
 
 @router.callback_query(F.data.startswith("extend:"))
 async def extend(c: CallbackQuery):
     order_id = int(c.data.split(":", 1)[1])
     ok, msg = await extend_reserve(order_id, c.from_user.id)
-    await c.answer(msg, show_alert=True)
-    c.data = f"status:{order_id}"
-    await status(c)
+    await show_status(c, order_id, msg)
 
 @router.callback_query(F.data.startswith("cancel:"))
 async def cancel(c: CallbackQuery):
     order_id = int(c.data.split(":", 1)[1])
-    await set_order_status(order_id, c.from_user.id, "CANCELLED")
+    if not await transition_order(order_id, c.from_user.id, "CANCELLED"):
+        await show_status(c, order_id, "Этот заказ уже нельзя отменить.")
+        return
     await c.message.edit_text(f"❌ Заказ № <b>{order_id}</b> отменён.", reply_markup=kb_main())
     await c.answer()
 
-# ----------------- АДМИН ДОБАВИТЬ ТОВАР -----------------
+# ----------------- АДМИН: КАТАЛОГ -----------------
 @router.message(Command("addproduct"))
 async def addproduct(m: Message):
     if m.from_user.id != ADMIN_ID:
@@ -502,21 +2649,654 @@ async def addproduct(m: Message):
     except:
         await m.answer("Цена должна быть числом.")
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO products(city,name,variant,price,description) VALUES(?,?,?,?,?)",
-            (city, name, variant, price, desc)
-        )
-        await db.commit()
+    await storage.upsert_products([(city, name, variant, price, desc)])
+    await catalog_cache.publish()
     await m.answer(f"✅ Добавлено: {city} / {name} / {variant} / {price} грн")
 
+@router.message(Command("import"))
+@router.message(F.document & F.caption.startswith("/import"))
+async def import_catalog(m: Message, bot: Bot):
+    if m.from_user.id != ADMIN_ID:
+        return
+    if not m.document:
+        await m.answer(
+            "Пришлите файл с подписью /import.\n"
+            "CSV с колонками: city,name,variant,price,description\n"
+            "или JSON Lines (.jsonl): по объекту с теми же полями на строку.\n"
+            "Существующие товары (город + название + вариант) обновляются."
+        )
+        return
+    fmt = catalog_format(m.document.file_name or "")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "import." + fmt)
+        await bot.download(m.document, destination=path)
+        res = await import_products(path, fmt)
+    text = f"✅ Импортировано: {res.imported}, ошибок: {res.errors}"
+    if res.first_errors:
+        # в ошибках — содержимое ячеек файла, а ответ уходит в HTML
+        text += "\n" + html.escape("\n".join(res.first_errors))
+    await m.answer(text)
+
+@router.message(Command("export"))
+async def export_catalog(m: Message):
+    if m.from_user.id != ADMIN_ID:
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "catalog.csv")
+        count = await export_products(path)
+        await m.answer_document(FSInputFile(path), caption=f"📤 Товаров: {count}")
+
+@router.message(Command("cachestats"))
+async def cachestats(m: Message):
+    if m.from_user.id != ADMIN_ID:
+        return
+    lines = [f"📊 Кэш каталога (версия {catalog_cache.version})"]
+    sections = [(name, getattr(catalog_cache, name)) for name in CatalogCache.SECTIONS]
+    sections.append(("users", user_profiles))
+    sections.append(("orders", callback_guard.results))
+    sections.append(("order views", order_views))
+    sections.append(("status texts", _status_texts))
+    for section, cache in sections:
+        st = cache.stats()
+        lines.append(
+            f"{section}: {st['size']}/{st['maxsize']}, "
+            f"hits {st['hits']}, misses {st['misses']}, hit rate {st['hit_rate']:.0%}"
+        )
+    await m.answer("\n".join(lines))
+
+# ----------------- АДМИН: ЗАКАЗЫ -----------------
+_ADMIN_ARG_RE = re.compile(r"(\w+)=(.*?)(?=\s+\w+=|$)")
+
+def _admin_args(text: str) -> dict[str, str]:
+    """«/orders status=PAID_REPORTED city=КРИВОЙ РОГ days=7» -> {"status": ..., "city": ..., "days": ...}"""
+    parts = text.split(maxsplit=1)
+    return dict(_ADMIN_ARG_RE.findall(parts[1].strip())) if len(parts) > 1 else {}
+
+ADMIN_ORDERS_HELP = (
+    "Фильтры: status=СТАТУС city=ГОРОД days=N\n"
+    "Статусы: " + ", ".join(ORDER_TRANSITIONS)
+)
+
+@router.message(Command("orders"))
+async def admin_orders(m: Message):
+    if m.from_user.id != ADMIN_ID:
+        return
+    args = _admin_args(m.text)
+    try:
+        f = order_filter(args)
+        page = await list_orders(f, args.get("after"))
+    except ValueError as e:
+        await m.answer(f"{html.escape(str(e))}\n{ADMIN_ORDERS_HELP}")
+        return
+    if not page.rows:
+        await m.answer("Заказов нет.\n" + ADMIN_ORDERS_HELP)
+        return
+    lines = [
+        f"№{oid} · {format_ts(created)} · {html.escape(city)} · {total} грн · {status} · user {uid}"
+        for oid, uid, city, _pid, total, status, created, _reserved, _ext in page.rows
+    ]
+    if page.next_cursor:
+        args["after"] = page.next_cursor
+        lines.append("\nДальше: /orders " + html.escape(" ".join(f"{k}={v}" for k, v in args.items())))
+    await m.answer("\n".join(lines))
+
+@router.message(Command("stats"))
+async def admin_stats(m: Message):
+    if m.from_user.id != ADMIN_ID:
+        return
+    args = _admin_args(m.text)
+    args.setdefault("days", "30")
+    try:
+        summary = await order_summary(order_filter(args))
+    except ValueError as e:
+        await m.answer(f"{html.escape(str(e))}\n{ADMIN_ORDERS_HELP}")
+        return
+    lines = [html.escape(f"📈 Заказы за {args['days']} дн." + (f", {args['city']}" if args.get("city") else ""))]
+    for title, st in [("Всего", summary["totals"]), *summary["by_city"].items()]:
+        statuses = ", ".join(f"{k} {v}" for k, v in st["by_status"].items()) or "—"
+        lines.append(
+            f"\n<b>{html.escape(title)}</b>: {st['orders']} заказов, конверсия {st['conversion']:.0%}\n"
+            f"Выручка {st['revenue']} грн, ожидает подтверждения {st['pending_revenue']} грн\n"
+            f"{statuses}"
+        )
+    await m.answer("\n".join(lines))
+
+@router.message(Command("orders_csv"))
+async def admin_orders_csv(m: Message):
+    if m.from_user.id != ADMIN_ID:
+        return
+    try:
+        f = order_filter(_admin_args(m.text))
+    except ValueError as e:
+        await m.answer(f"{e}\n{ADMIN_ORDERS_HELP}")
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "orders.csv")
+        count = await export_orders(path, f)
+        await m.answer_document(FSInputFile(path), caption=f"📤 Заказов: {count}")
+
+# ----------------- WEBHOOK -----------------
+WEBHOOK_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+class WebhookIngress:
+    """Приём webhook: секрет, ответ сразу, обработка задачами с backpressure (503)."""
+
+    def __init__(self, bot: Bot, dp: Dispatcher | None, secret: str,
+                 max_inflight: int = WEBHOOK_MAX_INFLIGHT,
+                 backpressure_timeout: float = WEBHOOK_BACKPRESSURE_SECONDS,
+                 forward=None, ready: asyncio.Event | None = None, journal: "UpdateJournal | None" = None):
+        self.bot = bot
+        self.dp = dp
+        self.secret = secret
+        self.forward = forward
+        self.journal = journal
+        self.ready = ready
+        self.backpressure_timeout = backpressure_timeout
+        self._slots = asyncio.Semaphore(max(1, max_inflight))
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def inflight(self) -> int:
+        return len(self._tasks)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(WEBHOOK_SECRET_HEADER, ""), self.secret):
+            return web.Response(status=401)
+        if self.ready is not None and not self.ready.is_set():
+            return web.Response(status=503)
+        if self.forward is not None:
+            try:
+                raw = await request.json()
+            except Exception:
+                return web.Response(status=400)
+            try:
+                await asyncio.wait_for(self.forward(raw), self.backpressure_timeout)
+            except asyncio.TimeoutError:
+                return web.Response(status=503)
+            return web.Response(text="ok")
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.backpressure_timeout)
+        except asyncio.TimeoutError:
+            return web.Response(status=503)
+        try:
+            raw = await request.json()
+            update = Update.model_validate(raw, context={"bot": self.bot})
+        except Exception:
+            self._slots.release()
+            return web.Response(status=400)
+        try:
+            # в журнал до ответа: после 200 Telegram апдейт уже не повторит
+            if self.journal is not None and not await self.journal.record_raw(raw):
+                self._slots.release()
+                return web.Response(text="ok")
+        except BaseException:
+            self._slots.release()
+            raise
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response(text="ok")
+
+    async def _process(self, update: Update):
+        try:
+            await self.dp.feed_update(self.bot, update, journaled=self.journal is not None)
+        except Exception:
+            logging.exception("Update %s failed", update.update_id)
+        finally:
+            self._slots.release()
+
+    async def drain(self):
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+# ----------------- ВОРКЕРЫ -----------------
+# Протокол ingest <-> воркер по unix-сокету: ingest пишет апдейт одной строкой
+# JSON, воркер после обработки отвечает строкой с его update_id.
+
+def update_user_id(raw: dict) -> int:
+    """id пользователя апдейта для шардинга; апдейты без пользователя идут в шард 0."""
+    for key, value in raw.items():
+        if key != "update_id" and isinstance(value, dict):
+            user = value.get("from") or value.get("user")
+            if isinstance(user, dict):
+                return int(user.get("id", 0))
+    return 0
+
+class WorkerLink:
+    """Соединение ingest с воркером: не больше max_inflight неподтверждённых апдейтов."""
+
+    def __init__(self, path: str, max_inflight: int = WORKER_MAX_INFLIGHT):
+        self.path = path
+        self.sent = 0
+        self.acked = 0
+        self.up = asyncio.Event()
+        self.on_lost = None
+        self._slots = asyncio.Semaphore(max(1, max_inflight))
+        self._writer: asyncio.StreamWriter | None = None
+        self._acks: asyncio.Task | None = None
+
+    @property
+    def inflight(self) -> int:
+        return self.sent - self.acked
+
+    async def connect(self, timeout: float = WORKER_START_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+        self._acks = asyncio.create_task(self._read_acks(reader))
+        self.up.set()
+
+    async def _read_acks(self, reader: asyncio.StreamReader):
+        try:
+            while await reader.readline():
+                self.acked += 1
+                self._slots.release()
+        except ConnectionError:
+            pass
+        logging.error("Worker %s closed the connection", self.path)
+        self.up.clear()
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
+        for _ in range(self.inflight):
+            self._slots.release()
+        self.acked = self.sent
+        if self.on_lost is not None:
+            self.on_lost(self)
+
+    async def reserve(self):
+        await self._slots.acquire()
+
+    def release(self):
+        self._slots.release()
+
+    async def write(self, raw: dict):
+        """Отправка после reserve(); пока воркер перезапускается — ждёт его."""
+        line = json.dumps(raw, ensure_ascii=False).encode() + b"\n"
+        while True:
+            await self.up.wait()
+            try:
+                self._writer.write(line)
+                await self._writer.drain()
+            except ConnectionError:
+                # воркер упал, а чтение подтверждений ещё не заметило
+                self.up.clear()
+                continue
+            self.sent += 1
+            return
+
+    async def close(self):
+        self.up.clear()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._acks is not None:
+            self._acks.cancel()
+            self._acks = None
+
+class UpdateRouter:
+    """Раздаёт апдейты воркерам по user id, с journal — только после записи в журнал."""
+
+    def __init__(self, links: list[WorkerLink], journal: "UpdateJournal | None" = None):
+        self.links = links
+        self.journal = journal
+        self.procs: list = []
+        self._respawn = None
+        self._down: set[int] = set()
+        self._cleared: set[str] = set()
+        self._restarts: set[asyncio.Task] = set()
+
+    def supervise(self, procs: list, respawn):
+        """respawn(index) перезапускает упавший воркер; пока шард лежит, /readyz отвечает 503."""
+        self.procs = procs
+        self._respawn = respawn
+        for index, link in enumerate(self.links):
+            link.on_lost = functools.partial(self._lost, index)
+
+    def unsupervise(self):
+        for link in self.links:
+            link.on_lost = None
+        for task in self._restarts:
+            task.cancel()
+
+    def _lost(self, index: int, link: WorkerLink):
+        if index in self._down:
+            return
+        self._down.add(index)
+        for check in ("cache", "bot"):
+            if check in readiness.done:
+                readiness.clear(check)
+                self._cleared.add(check)
+        task = asyncio.create_task(self._restart(index))
+        self._restarts.add(task)
+        task.add_done_callback(self._restarts.discard)
+
+    async def _restart(self, index: int):
+        link, delay = self.links[index], 1.0
+        while True:
+            logging.error("Worker %s is down, restarting", index)
+            old = self.procs[index]
+            old.terminate()
+            await asyncio.get_running_loop().run_in_executor(None, old.join, WORKER_START_TIMEOUT)
+            self.procs[index] = self._respawn(index)
+            try:
+                await link.connect()
+                break
+            except OSError:
+                logging.exception("Worker %s did not come back", index)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, NOTIFY_MAX_BACKOFF_SECONDS)
+        logging.info("✅ Worker %s restarted", index)
+        self._down.discard(index)
+        if not self._down:
+            for check in self._cleared:
+                readiness.mark(check)
+            self._cleared.clear()
+
+    @property
+    def inflight(self) -> int:
+        return sum(link.inflight for link in self.links)
+
+    async def dispatch(self, raw: dict):
+        link = self.links[update_user_id(raw) % len(self.links)]
+        # ожидание слота можно прервать (таймаут webhook), дальнейшее — нет:
+        # записанный в журнал апдейт должен дойти до воркера
+        await link.reserve()
+        await asyncio.shield(self._deliver(link, raw))
+
+    async def _deliver(self, link: WorkerLink, raw: dict):
+        try:
+            if self.journal is not None and not await self.journal.record_raw(raw):
+                link.release()
+                return
+        except BaseException:
+            link.release()
+            raise
+        await link.write(raw)
+
+    async def drain(self):
+        while self.inflight or self._down:
+            await asyncio.sleep(0.01)
+
+class WorkerServer:
+    """Сторона воркера: разные пользователи конкурентно, один пользователь — по очереди."""
+
+    def __init__(self, bot: Bot, dp: Dispatcher):
+        self.bot = bot
+        self.dp = dp
+        self._tails: dict[int, asyncio.Task] = {}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while line := await reader.readline():
+            raw = json.loads(line)
+            uid = update_user_id(raw)
+            task = asyncio.create_task(self._process(raw, writer, self._tails.get(uid)))
+            self._tails[uid] = task
+            task.add_done_callback(functools.partial(self._forget, uid))
+
+    def _forget(self, uid: int, task: asyncio.Task):
+        if self._tails.get(uid) is task:
+            del self._tails[uid]
+
+    async def _process(self, raw: dict, writer: asyncio.StreamWriter, previous: asyncio.Task | None):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            update = Update.model_validate(raw, context={"bot": self.bot})
+            # журнал апдейта уже записал ingest
+            await self.dp.feed_update(self.bot, update, journaled=True)
+        except Exception:
+            logging.exception("Update %s failed", raw.get("update_id"))
+        finally:
+            writer.write(f"{raw.get('update_id', 0)}\n".encode())
+
+async def worker_main(index: int, count: int, path: str):
+    await storage.open()
+    try:
+        await catalog_cache.warm()
+        catalog_cache.start_sync()
+        expiry_scheduler.shard = (index, count)
+        await expiry_scheduler.start()
+        bot = create_bot()
+        dp = create_dispatcher()
+        if JOURNAL_ENABLED:
+            # ingest шардирует по user id, поэтому чужие незавершённые апдейты не трогаем
+            update_journal.shard = (index, count)
+            update_journal.start()
+            await update_journal.replay(bot, dp)
+        server = await asyncio.start_unix_server(WorkerServer(bot, dp).handle, path)
+        logging.info("✅ Worker %s/%s listening on %s", index + 1, count, path)
+        try:
+            await server.serve_forever()
+        finally:
+            server.close()
+            await bot.session.close()
+    finally:
+        await catalog_cache.stop_sync()
+        await expiry_scheduler.stop()
+        await update_journal.stop()
+        await storage.close()
+
+def run_worker(index: int, count: int, path: str):
+    """Точка входа процесса-воркера; SIGTERM от ingest (или Ctrl+C) завершает его штатно."""
+    async def run():
+        task = asyncio.create_task(worker_main(index, count, path))
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            asyncio.get_running_loop().add_signal_handler(sig, task.cancel)
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    asyncio.run(run())
+
+async def start_workers(count: int, socket_dir: str) -> tuple[list, UpdateRouter]:
+    """Запускает count процессов-воркеров (spawn), подключается к каждому и
+    перезапускает тех, кто упадёт."""
+    ctx = multiprocessing.get_context("spawn")
+    paths = [os.path.join(socket_dir, f"worker-{index}.sock") for index in range(count)]
+
+    def spawn(index: int):
+        proc = ctx.Process(target=run_worker, args=(index, count, paths[index]), name=f"shop-worker-{index}")
+        proc.start()
+        return proc
+
+    procs = [spawn(index) for index in range(count)]
+    links = [WorkerLink(path) for path in paths]
+    for link in links:
+        await link.connect()
+    router = UpdateRouter(links)
+    router.supervise(procs, spawn)
+    return procs, router
+
+async def stop_workers(procs: list, router: UpdateRouter | None):
+    if router is not None:
+        router.unsupervise()
+        for link in router.links:
+            await link.close()
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        await asyncio.get_running_loop().run_in_executor(None, proc.join, WORKER_START_TIMEOUT)
+
+async def poll_updates(bot: Bot, dp: Dispatcher, accept):
+    """Long polling: offset сдвигается только после того, как accept(batch) принял апдейты."""
+    await bot.delete_webhook()
+    readiness.mark("bot")
+    logging.info("✅ POLLING STARTED" + (f" ({WORKERS} workers)" if WORKERS else ""))
+    allowed = dp.resolve_used_update_types()
+    offset = None
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed)
+            except Exception:
+                logging.exception("getUpdates failed, retrying")
+                await asyncio.sleep(1)
+                continue
+            if updates:
+                await accept(updates)
+                offset = updates[-1].update_id + 1
+    finally:
+        readiness.clear("bot")
+
+def forward_polled(forward):
+    """accept для poll_updates в режиме воркеров: апдейты по одному уходят в forward."""
+    async def accept(updates: list[Update]):
+        for update in updates:
+            await forward(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+    return accept
+
+def process_polled(bot: Bot, dp: Dispatcher, journal: UpdateJournal | None):
+    """accept для poll_updates в одном процессе: batch пишется в журнал одной группой,
+    обработка идёт задачами уже после сдвига offset."""
+    tasks: set[asyncio.Task] = set()
+
+    async def process(update: Update):
+        try:
+            await dp.feed_update(bot, update, journaled=journal is not None)
+        except Exception:
+            logging.exception("Update %s failed", update.update_id)
+
+    async def accept(updates: list[Update]):
+        if journal is not None:
+            fresh = await asyncio.gather(*(
+                journal.record_raw(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+                for update in updates
+            ))
+            updates = [update for update, new in zip(updates, fresh) if new]
+        for update in updates:
+            task = asyncio.create_task(process(update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    return accept
+
 # ----------------- WEB для Railway -----------------
+class Readiness:
+    """Этапы старта для /readyz: база открыта и мигрирована, кэши прогреты,
+    бот принимает апдейты (polling запущен или webhook выставлен)."""
+
+    CHECKS = ("storage", "cache", "bot")
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.done: dict[str, float] = {}
+
+    @property
+    def ready(self) -> bool:
+        return all(check in self.done for check in self.CHECKS)
+
+    def mark(self, check: str):
+        if check not in self.done:
+            self.done[check] = time.monotonic() - self.started
+            logging.info("✅ Ready: %s (%.3f s after start)", check, self.done[check])
+
+    def clear(self, check: str):
+        self.done.pop(check, None)
+
+    def status(self) -> dict:
+        return {"ready": self.ready, "checks": {check: self.done.get(check) for check in self.CHECKS}}
+
+readiness = Readiness()
+
 async def handle_root(request):
     return web.Response(text="ok")
 
-async def start_web_server():
+async def handle_healthz(request):
+    # liveness: процесс жив и event loop отвечает; healthcheck платформы — на /readyz
+    return web.Response(text="ok")
+
+async def handle_readyz(request):
+    return web.json_response(readiness.status(), status=200 if readiness.ready else 503)
+
+async def handle_metrics(request):
+    gauges = {
+        "bot_expiry_pending": ("Заказы, ожидающие истечения брони", len(expiry_scheduler)),
+        "bot_user_cache_size": ("Профилей в кэше", len(user_profiles)),
+        "bot_user_cache_hit_rate": ("Доля попаданий в кэш профилей", user_profiles.stats()["hit_rate"]),
+        "bot_order_cache_hit_rate": ("Доля попаданий в кэш заказов", order_views.stats()["hit_rate"]),
+        "bot_catalog_cache_version": ("Версия каталога", catalog_cache.version),
+    }
+    for section in CatalogCache.SECTIONS:
+        gauges[f"bot_catalog_cache_{section}_hit_rate"] = (
+            f"Доля попаданий в кэш каталога ({section})", getattr(catalog_cache, section).stats()["hit_rate"]
+        )
+    return web.Response(text=metrics.render(gauges), content_type="text/plain", charset="utf-8")
+
+def _admin_request(request) -> OrderFilter:
+    """Проверяет Bearer-токен и разбирает фильтр из query; ошибки — HTTP 401/400."""
+    auth = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(auth.encode(), f"Bearer {ADMIN_API_TOKEN}".encode()):
+        raise web.HTTPUnauthorized()
+    try:
+        return order_filter(request.query)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+async def handle_admin_orders(request):
+    f = _admin_request(request)
+    try:
+        limit = min(ADMIN_PAGE_MAX, max(1, int(request.query.get("limit", ADMIN_PAGE_SIZE))))
+        page = await list_orders(f, request.query.get("cursor"), limit)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    return web.json_response({
+        "orders": [dict(zip(ORDER_COLUMNS, row)) for row in page.rows],
+        "next_cursor": page.next_cursor,
+    })
+
+async def handle_admin_stats(request):
+    return web.json_response(await order_summary(_admin_request(request)))
+
+async def handle_admin_orders_csv(request):
+    f = _admin_request(request)
+    resp = web.StreamResponse(headers={"Content-Disposition": 'attachment; filename="orders.csv"'})
+    resp.content_type = "text/csv"
+    resp.charset = "utf-8"
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    async for chunk in iter_orders_csv(f):
+        await resp.write(chunk.encode())
+    await resp.write_eof()
+    return resp
+
+def web_routes(webhook: WebhookIngress | None = None) -> list[tuple[str, str, object]]:
+    """(метод, путь, хендлер) веб-сервера; их же монтирует run.py на уже запущенный сервер."""
+    routes = [
+        ("GET", "/", handle_root),
+        ("GET", "/healthz", handle_healthz),
+        ("GET", "/readyz", handle_readyz),
+    ]
+    if metrics.enabled:
+        routes.append(("GET", "/metrics", handle_metrics))
+    if ADMIN_API_TOKEN:
+        routes += [
+            ("GET", "/admin/orders", handle_admin_orders),
+            ("GET", "/admin/orders.csv", handle_admin_orders_csv),
+            ("GET", "/admin/stats", handle_admin_stats),
+        ]
+    if webhook is not None:
+        routes.append(("POST", WEBHOOK_PATH, webhook.handle))
+    return routes
+
+def create_web_app(webhook: WebhookIngress | None = None) -> web.Application:
     app = web.Application()
-    app.router.add_get("/", handle_root)
+    for method, path, handler in web_routes(webhook):
+        if method == "GET":
+            app.router.add_get(path, handler)  # вместе с HEAD
+        else:
+            app.router.add_route(method, path, handler)
+    return app
+
+async def start_web_server(webhook: WebhookIngress | None = None):
+    app = create_web_app(webhook)
     port = int(os.getenv("PORT", "8080"))
     runner = web.AppRunner(app)
     await runner.setup()
@@ -524,27 +3304,112 @@ async def start_web_server():
     await site.start()
     logging.info("✅ WEB server started on port %s", port)
 
-async def start_bot():
+def create_bot(**kwargs) -> Bot:
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN не задан в Variables.")
 
-    from aiogram.client.default import DefaultBotProperties
-    from aiogram.enums import ParseMode
+    if TELEGRAM_API_URL and "session" not in kwargs:
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+        kwargs["session"] = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
 
     bot = Bot(
         BOT_TOKEN,
-        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+        **kwargs
     )
+    if metrics.enabled:
+        bot.session.middleware(TelegramMetricsMiddleware())
+    return bot
+
+def create_dispatcher() -> Dispatcher:
     dp = Dispatcher()
+    if JOURNAL_ENABLED:
+        dp.update.outer_middleware(update_journal)
     dp.include_router(router)
+    return dp
+
+async def start_bot(bot: Bot, dp: Dispatcher):
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        readiness.mark("bot")
+        logging.info("✅ WEBHOOK SET: %s%s", WEBHOOK_URL.rstrip("/"), WEBHOOK_PATH)
+        await asyncio.Event().wait()
+        return
 
-    logging.info("✅ POLLING STARTED")
-    await dp.start_polling(bot)
+    # не dp.start_polling: он сдвигает offset раньше, чем апдейт попал в журнал
+    await poll_updates(bot, dp, process_polled(bot, dp, update_journal if JOURNAL_ENABLED else None))
 
-async def main():
+async def run_ingest(bot: Bot, dp: Dispatcher, webhook: WebhookIngress | None, accepting: asyncio.Event):
+    """Режим WORKERS>0: приём апдейтов и уведомления здесь, обработка — в воркерах."""
+    procs, updates = [], None
+    with tempfile.TemporaryDirectory(prefix="shop-workers-") as socket_dir:
+        try:
+            procs, updates = await start_workers(WORKERS, socket_dir)
+            if JOURNAL_ENABLED:
+                updates.journal = update_journal
+            # воркер открывает сокет только после прогрева своих кэшей
+            readiness.mark("cache")
+            if webhook is not None:
+                webhook.forward = updates.dispatch
+            accepting.set()
+            notifier.start(bot, poll_interval=NOTIFY_POLL_SECONDS)
+            if WEBHOOK_URL:
+                await start_bot(bot, dp)
+            else:
+                await poll_updates(bot, dp, forward_polled(updates.dispatch))
+        finally:
+            await stop_workers(procs, updates)
+
+async def open_storage():
+    await storage.open()
     await init_db()
     await seed_demo_products()
-    await asyncio.gather(start_web_server(), start_bot())
+    if CATALOG_IMPORT_PATH:
+        await import_products(CATALOG_IMPORT_PATH)
+    readiness.mark("storage")
+
+async def main(mount=None):
+    """mount(routes) — веб-сервер уже запущен (run.py), маршруты передаются ему."""
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET не задан в Variables.")
+    bot = create_bot()
+    dp = create_dispatcher()
+    # веб-сервер поднимается первым: /healthz отвечает сразу, /readyz — когда готово всё,
+    # а webhook до этого отвечает 503, и Telegram доставит апдейт повторно
+    accepting = asyncio.Event()
+    webhook = None
+    if WEBHOOK_URL:
+        webhook = WebhookIngress(bot, dp if WORKERS == 0 else None, WEBHOOK_SECRET, ready=accepting,
+                                 journal=update_journal if JOURNAL_ENABLED and WORKERS == 0 else None)
+    if mount is None:
+        await start_web_server(webhook)
+    else:
+        mount(web_routes(webhook))
+    try:
+        await open_storage()
+        if WORKERS > 0:
+            await run_ingest(bot, dp, webhook, accepting)
+            return
+        await asyncio.gather(catalog_cache.warm(), expiry_scheduler.start())
+        if JOURNAL_ENABLED:
+            # до приёма новых апдейтов: доделываем то, что прервал прошлый процесс
+            update_journal.start()
+            await update_journal.replay(bot, dp)
+        readiness.mark("cache")
+        accepting.set()
+        notifier.start(bot)
+        await start_bot(bot, dp)
+    finally:
+        await notifier.stop()
+        await expiry_scheduler.stop()
+        await update_journal.stop()
+        await storage.close()
+        readiness.clear("storage")
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,60 @@
+"""Точка входа для платформы: веб-сервер поднимается раньше, чем импортируется бот.
+
+Импорт main (aiogram, pydantic-модели апдейтов) занимает секунды, и всё это время
+порт не слушался бы. Здесь сначала открывается порт: /healthz сразу отвечает
+"ok", остальные пути — 503, а main импортируется в потоке, не блокируя event loop.
+После импорта main.main() монтирует свои маршруты (/readyz, webhook, /metrics,
+/admin/*) на этот же сервер.
+"""
+import asyncio
+import importlib
+import logging
+import os
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+
+
+class LateRoutes:
+    """Маршруты, которые появятся после импорта main; до этого — только liveness."""
+
+    def __init__(self):
+        self.routes: dict[tuple[str, str], object] | None = None
+
+    def mount(self, routes):
+        self.routes = {(method, path): handler for method, path, handler in routes}
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        if self.routes is None:
+            if request.path == "/healthz":
+                return web.Response(text="ok")
+            return web.Response(status=503)
+        method = "GET" if request.method == "HEAD" else request.method
+        handler = self.routes.get((method, request.path))
+        if handler is None:
+            known = any(path == request.path for _, path in self.routes)
+            return web.Response(status=405 if known else 404)
+        return await handler(request)
+
+
+async def serve():
+    late = LateRoutes()
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", late.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = int(os.getenv("PORT", "8080"))
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    logging.info("✅ WEB server started on port %s", port)
+    try:
+        bot = await asyncio.get_running_loop().run_in_executor(None, importlib.import_module, "main")
+        await bot.main(mount=late.mount)
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve())